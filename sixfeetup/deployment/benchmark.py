@@ -0,0 +1,107 @@
+"""Compare reading tags straight from the repository with running
+`git tag` / `hg tags`.
+
+Usage: python -m sixfeetup.deployment.benchmark [number of tags] [rounds]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from jarn.mkrelease.scm import Git, Mercurial
+
+# Patch the scm classes
+from sixfeetup.deployment import scm
+
+
+def _call(cmd, cwd, stdin=None):
+    proc = subprocess.Popen(cmd, cwd=cwd, shell=True,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate(stdin)[0]
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (cmd, output))
+    return output
+
+
+def _make_git_repo(path, count):
+    _call('git init -q .', path)
+    _call('git -c user.name=bench -c user.email=bench@example.com '
+          'commit -q --allow-empty -m init', path)
+    head = _call('git rev-parse HEAD', path).strip()
+    half = count // 2
+    # half of the tags packed, half loose, like a repository that has been
+    # gc'ed at some point
+    refs = ''.join(['create refs/tags/1.%s %s\n' % (i, head)
+                    for i in range(half)])
+    _call('git update-ref --stdin', path, refs)
+    _call('git pack-refs --all', path)
+    refs = ''.join(['create refs/tags/2.%s %s\n' % (i, head)
+                    for i in range(count - half)])
+    _call('git update-ref --stdin', path, refs)
+
+
+def _make_hg_repo(path, count):
+    _call('hg init', path)
+    with open(os.path.join(path, 'README'), 'w') as f:
+        f.write('benchmark\n')
+    _call('hg -q commit -A -u bench -m init', path)
+    node = _call('hg tip --template "{node}"', path).strip()
+    with open(os.path.join(path, '.hgtags'), 'w') as f:
+        for i in range(count):
+            f.write('%s 1.%s\n' % (node, i))
+    _call('hg -q commit -A -u bench -m tags', path)
+
+
+def _time(func, rounds):
+    start = time.time()
+    for i in range(rounds):
+        result = func()
+    return (time.time() - start) / rounds, result
+
+
+def _compare(name, wc, path, rounds):
+    command_time, command_tags = _time(
+        lambda: wc.list_tags_command(path), rounds)
+    native_time, native_tags = _time(
+        lambda: wc.list_tags(path), rounds)
+    if sorted(command_tags) != sorted(native_tags):
+        print '%s: tag lists differ (%s vs %s tags)' % (
+            name, len(command_tags), len(native_tags))
+    print '%-4s %6s tags  command: %8.2fms  native: %8.2fms  (%.1fx)' % (
+        name, len(native_tags), command_time * 1000, native_time * 1000,
+        command_time / max(native_time, 1e-9))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    count = 5000
+    rounds = 10
+    if args:
+        count = int(args[0])
+    if len(args) > 1:
+        rounds = int(args[1])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        git_path = os.path.join(tmp_dir, 'git')
+        os.mkdir(git_path)
+        _make_git_repo(git_path, count)
+        _compare('git', Git(), git_path, rounds)
+        hg_path = os.path.join(tmp_dir, 'hg')
+        os.mkdir(hg_path)
+        try:
+            _make_hg_repo(hg_path, count)
+        except (OSError, RuntimeError) as e:
+            print 'hg: skipped (%s)' % str(e).strip().splitlines()[0]
+        else:
+            _compare('hg', Mercurial(), hg_path, rounds)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
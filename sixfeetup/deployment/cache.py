@@ -0,0 +1,57 @@
+import os
+import pickle
+import tempfile
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+
+def _load_cache(path):
+    """Load a pickled cache file, returning an empty dict if it is missing
+    or unreadable
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return data
+
+
+def _save_cache(path, data):
+    """Write a cache file atomically so an interrupted write never leaves a
+    truncated file behind
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _file_signature(paths):
+    """Return a signature for the given files made up of their mtime, size
+    and content hash. Missing files are part of the signature too.
+    """
+    signature = []
+    for path in paths:
+        if not os.path.exists(path):
+            signature.append((os.path.basename(path), None))
+            continue
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = md5(f.read()).hexdigest()
+        signature.append((os.path.basename(path),
+                          (stat.st_mtime, stat.st_size, digest)))
+    return tuple(signature)
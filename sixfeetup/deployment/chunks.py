@@ -0,0 +1,68 @@
+"""A content addressed store for Data.fs copies on the data host.
+
+A Data.fs is split into fixed size chunks that are stored under their
+checksum in one directory, and the copy itself becomes a recipe listing its
+chunks. Consecutive copies of a mostly unchanged Data.fs only add the chunks
+that changed.
+"""
+import os
+
+from fabric import api
+
+STORE_SCRIPT = """\
+set -e; mkdir -p "%(chunk_dir)s"; \
+size=$(wc -c < "%(source)s"); \
+n=$(( (size + %(chunk_size)s - 1) / %(chunk_size)s )); i=0; \
+: > "%(recipe)s.part"; \
+while [ $i -lt $n ]; do \
+h=$(dd if="%(source)s" bs=%(chunk_size)s skip=$i count=1 2>/dev/null | \
+%(checksum)s | cut -d" " -f1); \
+if [ -e "%(chunk_dir)s/$h" ]; then touch "%(chunk_dir)s/$h"; else \
+dd if="%(source)s" bs=%(chunk_size)s skip=$i count=1 \
+of="%(chunk_dir)s/$h.tmp" 2>/dev/null; \
+mv "%(chunk_dir)s/$h.tmp" "%(chunk_dir)s/$h"; fi; \
+echo $h >> "%(recipe)s.part"; i=$((i + 1)); done; \
+mv "%(recipe)s.part" "%(recipe)s"\
+"""
+RESTORE_SCRIPT = """\
+while read h; do cat "%(chunk_dir)s/$h"; done < "%(recipe)s" \
+> "%(target)s.part" && mv "%(target)s.part" "%(target)s"\
+"""
+# Chunks that were written or reused in the last hour are never collected,
+# they may belong to a recipe that is still being written.
+COLLECT_SCRIPT = """\
+cd "%(data_path)s" && \
+cat /dev/null *.chunks *.chunks.part 2>/dev/null | sort -u > .chunks-keep; \
+(cd "%(chunk_dir)s" && find . -type f -mmin +60 | sed "s|^\\./||" | sort) \
+> .chunks-all; \
+comm -23 .chunks-all .chunks-keep | (cd "%(chunk_dir)s" && xargs rm -f); \
+rm -f .chunks-keep .chunks-all\
+"""
+
+
+def _get_chunk_dir(data_path):
+    return os.path.join(data_path, 'chunks')
+
+
+def _store_chunks(source, recipe, chunk_dir):
+    """Store a file in the chunk store and write its recipe, call this on
+    the data host
+    """
+    chunk_size = int(api.env.data_chunk_size_mb) * 1024 * 1024
+    checksum = api.env.data_checksum_command
+    return api.run(STORE_SCRIPT % locals())
+
+
+def _restore_chunks(recipe, target, chunk_dir):
+    """Put the file described by a recipe back together, call this on the
+    data host
+    """
+    return api.run(RESTORE_SCRIPT % locals())
+
+
+def _collect_chunks(data_path):
+    """Remove the chunks that no recipe uses anymore, call this on the
+    data host
+    """
+    chunk_dir = _get_chunk_dir(data_path)
+    return api.run(COLLECT_SCRIPT % locals())
@@ -2,6 +2,8 @@ from fabric import api
 from sixfeetup.deployment.release import SETUPPY_VERSION
 from sixfeetup.deployment.release import *
 from sixfeetup.deployment.data import *
+from sixfeetup.deployment.plan import execute_plan
+from sixfeetup.deployment.rollback import rollback_release
 
 # URL to the trac instance base
 api.env.trac_url_base = 'https://trac.sixfeetup.com'
@@ -18,12 +20,43 @@ api.env.default_version_location = ['setup.py', SETUPPY_VERSION]
 api.env.versions_cfg_location = "profiles/versions.cfg"
 # List of packages to release
 api.env.to_release = []
+# Number of packages released at the same time. Packages that require
+# other packages in the release wait for those to be released first.
+api.env.release_workers = 1
+# Commit the version changes of all the packages in a working copy in one
+# commit, with the working copies committed at the same time
+api.env.scm_batch_commits = True
+# Log of the package choices and what happened to each package, used to
+# resume deploy after a failure
+api.env.deploy_state = '.deploy_state'
+# Journal of the steps execute_plan finished, used to resume a failed run
+api.env.plan_journal = '.deploy_journal'
+# Journal of the tags, uploads, commits and edits of each release, used by
+# rollback_release. Set to an empty string to turn it off.
+api.env.release_journal = '.release_journal'
 # This is a directory that contains the eggs we want to release
 api.env.package_dirs = ['src']
 # List of package path names to ignore (e.g. 'my.package')
 api.env.ignore_dirs = []
 # extra information for a package
 api.env.package_info = {}
+# Number of processes used to read package metadata, 0 means one per CPU
+api.env.discovery_processes = 1
+# Cache of package names and versions, keyed on setup.py/setup.cfg changes.
+# Set to an empty string to disable the cache.
+api.env.package_cache = '.package_cache'
+# Number of threads used to list tags and diff packages before prompting
+api.env.scm_threads = 8
+# Local index of the tags of each working copy, invalidated when the
+# repository changes (for svn on any commit to the repository, which is
+# asked once per run). Set to an empty string to disable the index.
+api.env.tag_index = '.tag_index'
+# Stop showing a diff after this many lines or files, 0 means no limit
+api.env.diff_max_lines = 0
+api.env.diff_max_files = 0
+# Diffs up to this many lines are fetched before the first prompt, longer
+# ones are streamed when they are shown
+api.env.diff_prefetch_lines = 1000
 # testing server host
 api.env.testing_hosts = ["sfupqaapp01"]
 api.env.staging_hosts = ["sfupstaging01"]
@@ -33,6 +66,40 @@ api.env.data_hosts = ['extranet']
 # Data base path
 api.env.base_data_path = '/usr/local/www/data'
 api.env.full_data_path = ''
+# How sync_data stores data: "archive" keeps a .tgz of every sync,
+# "mirror" keeps dated rsync snapshots per role that share unchanged files
+api.env.data_sync_mode = 'archive'
+# Number of rsync streams run at the same time by sync_data
+api.env.data_sync_workers = 8
+# Number of rsync streams the blobstorage is split over (at most 16)
+api.env.data_blob_streams = 4
+# Seconds after which a data sync lock is considered stale and taken over
+api.env.data_lock_timeout = 6 * 60 * 60
+# Seconds between checks while waiting for another sync to finish
+api.env.data_lock_poll = 30
+# How Data.fs archives are compressed: gzip, pigz, zstd or none, or chunks
+# to store them deduplicated in the chunk store
+api.env.data_archive_codec = 'gzip'
+# Compression level, empty for the codec's default
+api.env.data_archive_level = ''
+# Threads used by pigz and zstd, 0 lets them decide
+api.env.data_archive_threads = 0
+# Compress Data.fs while it is transferred instead of after rsync
+api.env.data_archive_stream = False
+# Size of the pieces the chunks codec stores Data.fs in, in MB
+api.env.data_chunk_size_mb = 64
+# How many of the newest daily, weekly and monthly copies per role
+# prune_saved_data keeps
+api.env.data_keep_daily = 7
+api.env.data_keep_weekly = 4
+api.env.data_keep_monthly = 6
+# Command writing the checksum manifest next to each archive, its output
+# has to start with the hex digest (e.g. "sha256 -r" on FreeBSD)
+api.env.data_checksum_command = 'sha256sum'
+# Number of parallel ssh streams get_saved_data downloads with
+api.env.data_download_streams = 4
+# How push_saved_data_to_qa copies to the QA hosts: serial, parallel or tree
+api.env.qa_push_mode = 'serial'
 # Base path to instances
 api.env.base_testing_path = "/var/db/zope/dev"
 api.env.base_staging_path = "/var/db/zope"
@@ -47,4 +114,55 @@ api.env.staging_supervisor_processes = ""
 api.env.prod_supervisor_processes = ""
 # tag number
 api.env.deploy_tag = ""
+# How the buildout is updated: "inplace" stops the site, switches and runs
+# buildout. "slots" builds the new tag in a release slot next to the
+# running one and only stops the site to switch the symlink over. Run
+# setup_release_slots once before using it.
+api.env.deploy_mode = 'inplace'
+# Number of release slots kept around for rollback_slot
+api.env.release_slots_keep = 3
+# Compare the deployed tag with the new one and skip buildout when only
+# buildout_inert_files changed, or run it offline when the only other
+# changes are pins of eggs that are already installed
+api.env.buildout_change_detection = True
+# Files buildout never reads, changing them doesn't need a buildout run.
+# Patterns with a / match the path in the buildout, others the file name.
+api.env.buildout_inert_files = ['README*', 'CHANGES*', 'HISTORY*',
+                                'CHANGELOG*', 'LICENSE*', 'version.txt',
+                                'docs', 'docs/*', 'doc', 'doc/*']
+# Config files that only hold version pins
+api.env.buildout_versions_files = ['versions.cfg']
+# Egg directories checked for the new pins, relative to the buildout
+api.env.buildout_eggs_dirs = ['eggs']
+# How release_to goes through the hosts: serial, all, batch or canary
+api.env.rollout = 'serial'
+# Hosts per batch for the batch and canary rollouts, 0 means all of them
+api.env.rollout_batch_size = 0
+# Maximum number of hosts released at the same time, 0 means no limit
+api.env.rollout_concurrency = 0
+# Check all the hosts with preflight before release_to touches any of them
+api.env.rollout_preflight = True
+# Free space in MB the buildout's disk needs for preflight to pass
+api.env.preflight_min_free_mb = 1024
+# Base URLs of the Zope instances on each host, e.g. http://localhost:8080.
+# After a restart release_to waits for them to come up and warms them up
+# before going on, leave them empty to not wait.
+api.env.testing_instance_urls = []
+api.env.staging_instance_urls = []
+api.env.prod_instance_urls = []
+# Path that answers with 200 once an instance is up
+api.env.health_path = '/'
+# Paths requested at the same time to fill the caches of an instance
+api.env.warmup_paths = ['/']
+# An instance is warm once all the warm-up paths answer within this many
+# seconds
+api.env.warmup_max_latency = 2.0
+# Seconds an instance gets to come up and warm up before the release aborts
+api.env.warmup_timeout = 300
+# ssh control socket used to share one connection per host for the commands
+# run through the system's ssh, %(pid)s is replaced with the process id.
+# Set to an empty string to open a new connection for every command.
+api.env.ssh_control_path = '/tmp/sfup-%(pid)s-%%r@%%h:%%p'
+# Seconds an idle master connection stays open
+api.env.ssh_control_persist = 600
 api.env.sudo_prefix = '%s%s ' % (api.env.sudo_prefix, '-H')
@@ -1,8 +1,29 @@
 import os
+import calendar
 import datetime
+import fnmatch
+import getpass
+import json
+import re
+import socket
+import time
 from fabric import api
-from sixfeetup.deployment.utils import (_quiet_remote_ls,
+from fabric import contrib
+from sixfeetup.deployment.chunks import (_collect_chunks,
+                                         _get_chunk_dir,
+                                         _restore_chunks,
+                                         _store_chunks)
+from sixfeetup.deployment.parallel import _run_pool
+from sixfeetup.deployment.transfer import (_download,
+                                           _fan_out,
+                                           _remote_size,
+                                           _write_checksum)
+from sixfeetup.deployment.utils import TRUISMS
+from sixfeetup.deployment.utils import (_local_run,
+                                        _quiet_remote_ls,
                                         _quiet_remote_mkdir,
+                                        _remote_batch,
+                                        _sshagent_command,
                                         _sshagent_run)
 
 
@@ -14,6 +35,51 @@ Current saved data files:
 %(current_data_string)s
 
 Enter a file name to %(saved_data_action)s:"""
+# The ways saved data can be compressed. The commands read a tar stream on
+# stdin and write the compressed stream to stdout.
+ARCHIVE_CODECS = {
+    'gzip': {
+        'extension': '.tgz',
+        'compress': 'gzip -%(level)s',
+        'level': 6,
+    },
+    'pigz': {
+        'extension': '.tgz',
+        'compress': 'pigz -%(level)s%(threads)s',
+        'threads': ' -p %s',
+        'level': 6,
+    },
+    'zstd': {
+        'extension': '.tar.zst',
+        'compress': 'zstd -q -%(level)s%(threads)s',
+        'threads': ' -T%s',
+        # zstd uses one thread unless told otherwise
+        'default_threads': ' -T0',
+        'level': 3,
+    },
+    'none': {
+        'extension': '.tar',
+        'compress': None,
+    },
+    # Data.fs goes into the chunk store and the archive only lists its
+    # chunks, it is turned into a .tar when it is retrieved
+    'chunks': {
+        'extension': '.chunks',
+        'compress': None,
+        'chunked': True,
+    },
+}
+
+
+# The catalog of the archives on each data host, a JSON object per line.
+# Archives that are removed get a line with "removed" set.
+CATALOG_NAME = 'catalog.jsonl'
+# tar options that don't record who restored an archive, for GNU and BSD tar
+TAR_FIXED_OWNER = ('$(tar --version 2>/dev/null | grep -q GNU && '
+                   'echo --owner=0 --group=0 --numeric-owner || '
+                   'echo --uid 0 --gid 0 --uname root --gname wheel)')
+# The dated snapshots of a mirror, YYYY-MM-DD-NN
+SNAPSHOT_RE = re.compile(r'^(\d{4}-\d\d-\d\d)-(\d+)$')
 
 
 def _get_data_path():
@@ -26,102 +92,886 @@ def _get_data_path():
     return full_path
 
 
-def list_saved_data(fname_filter='*.tgz'):
-    """List saved data files from the data server
+def _archive_filter():
+    """A filter for ls that matches the archives of all the codecs
+    """
+    extensions = []
+    for codec in ARCHIVE_CODECS.values():
+        if codec['extension'] not in extensions:
+            extensions.append(codec['extension'])
+    # keep the errors for the extensions without files out of the listing
+    return ' '.join(['*%s' % ext for ext in extensions]) + ' 2>/dev/null'
+
+
+def _catalog_path():
+    return os.path.join(_get_data_path(), CATALOG_NAME)
+
+
+def _append_catalog(entries):
+    """Add entries to the catalog, call this on the data host. Appending
+    small lines is atomic, so syncs of different roles can do this at the
+    same time.
+    """
+    lines = []
+    for entry in entries:
+        line = json.dumps(entry, sort_keys=True)
+        lines.append("'%s'" % line.replace("'", "'\\''"))
+    with api.settings(api.hide('running')):
+        return api.run("printf '%%s\\n' %s >> %s" % (' '.join(lines),
+                                                    _catalog_path()))
+
+
+def _catalog_archive(path, role, date, source, codec, timestamp=None):
+    """Record a new archive in the catalog, call this on the data host
     """
-    full_path = _get_data_path()
-    path_filter = os.path.join(full_path, fname_filter)
+    (size_rc, size), (sum_rc, checksum), (now_rc, now) = _remote_batch([
+        'wc -c < %s' % path, 'cat %s.sha256' % path, 'date +%s'])
+    if timestamp is None:
+        timestamp = int(now.strip())
+    size = size.strip()
+    checksum = checksum.split()
+    _append_catalog([{
+        'name': os.path.basename(path),
+        'role': role,
+        'date': date,
+        'timestamp': timestamp,
+        'size': size_rc == 0 and size.isdigit() and int(size) or None,
+        'checksum': sum_rc == 0 and checksum and checksum[0] or None,
+        'source': source,
+        'codec': codec,
+    }])
+
+
+def _read_catalog():
+    """The archives in the catalog of the current data host, oldest first.
+    Returns None when the host has no catalog.
+    """
+    with api.settings(api.hide('running', 'stdout', 'warnings'),
+                      warn_only=True):
+        result = api.run('cat %s' % _catalog_path())
+    if result.failed:
+        return None
+    entries = {}
+    for line in result.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # a line that was cut short
+            continue
+        if entry.get('removed'):
+            entries.pop(entry['name'], None)
+        else:
+            entries[entry['name']] = entry
+    return sorted(entries.values(),
+                  key=lambda entry: (entry['timestamp'], entry['name']))
+
+
+def _catalog_entries(fname_filter=None, role=None, since=None, until=None):
+    """The archives in the catalogs of all the data hosts that match the
+    filters, oldest first. since and until are dates like 2010-01-31.
+    """
+    found = []
     for host in api.env.data_hosts:
-        api.puts('%s: "%s"' % (host, path_filter))
         with api.settings(host_string=host):
-            current_files = _quiet_remote_ls(full_path, fname_filter)
-            api.puts(current_files)
-            return current_files.split()
+            entries = _read_catalog()
+        if entries is None:
+            api.puts('%s has no catalog of saved data, run '
+                     'index_saved_data to create it' % host)
+            continue
+        for entry in entries:
+            if fname_filter and not fnmatch.fnmatch(entry['name'],
+                                                    fname_filter):
+                continue
+            if role and entry['role'] != role:
+                continue
+            if (since and entry['date'] < since or
+              until and entry['date'] > until):
+                continue
+            entry['host'] = host
+            found.append(entry)
+    found.sort(key=lambda entry: (entry['timestamp'], entry['name']))
+    return found
+
+
+def _format_entry(entry):
+    size = '?'
+    if entry.get('size') is not None:
+        size = '%.1f MB' % (entry['size'] / 1024.0 / 1024)
+    host = ''
+    if len(api.env.data_hosts) > 1:
+        host = '%s: ' % entry['host']
+    return '%s%s  (%s, %s, from %s)' % (host, entry['name'], entry['role'],
+                                        size, entry['source'])
 
 
-def _get_data_fname(saved_data_action='retrieve'):
-   hide_levels = ['warnings', 'running', 'stdout', 'stderr',
-                  'user']
+def list_saved_data(fname_filter=None, role=None, since=None, until=None):
+    """List saved data files from the data servers
+
+    The files can be filtered by a glob on the name, by role and by date
+    (since and until are dates like 2010-01-31).
+    """
+    entries = _catalog_entries(fname_filter, role, since, until)
+    for entry in entries:
+        api.puts(_format_entry(entry))
+    return [entry['name'] for entry in entries]
+
+
+def _saved_data_host(entries, fname):
+    """The data host that has a saved data file
+    """
+    for entry in reversed(entries):
+        if entry['name'] == fname:
+            return entry['host']
+    return api.env.data_hosts[0]
+
+
+def _get_data_fname(saved_data_action='retrieve', role=None):
+   hide_levels = ['warnings', 'running', 'stdout', 'stderr']
    with api.settings(api.hide(*hide_levels), warn_only=True):
-       current_data = list_saved_data()
-       current_data_string = '\t' + '\n\t'.join(current_data)
-       most_recent_data = current_data[-1]
+       current_data = _catalog_entries(role=role)
+   if not current_data:
+       api.abort('There is no saved data to %s' % saved_data_action)
+   current_data_string = '\t' + '\n\t'.join(
+       [_format_entry(entry) for entry in current_data])
+   most_recent_data = current_data[-1]['name']
    help_txt = DATA_HELP_TEXT % locals()
-   return api.prompt(help_txt, default=most_recent_data)
+   fname = api.prompt(help_txt, default=most_recent_data)
+   return _saved_data_host(current_data, fname), fname
+
+
+def _find_saved_data(fname, saved_data_action='retrieve', role=None):
+    """Prompt for a saved data file unless fname is given, returns the data
+    host that has it and its name
+    """
+    if fname is None:
+        return _get_data_fname(saved_data_action, role)
+    with api.settings(api.hide('user')):
+        return _saved_data_host(_catalog_entries(fname), fname), fname
 
 
-def get_saved_data(fname=None):
+def get_saved_data(fname=None, streams=None, role=None):
     """Retrieve a saved data file from the data server
+
+    The file is fetched over `streams` parallel ssh connections, resumes
+    when run again after an interruption and is checked against the
+    checksum written when the archive was created. Without a file name the
+    newest file, of the given role if there is one, is offered.
     """
-    for host in api.env.data_hosts:
-        with api.settings(host_string=host):
-            if fname is None:
-                fname = _get_data_fname()
-            api.get(os.path.join(_get_data_path(), fname), fname)
+    if streams is None:
+        streams = api.env.data_download_streams
+    host, fname = _find_saved_data(fname, role=role)
+    with api.settings(host_string=host):
+        fpath, restore_dir = _materialize_archive(fname)
+        try:
+            _download(fpath, os.path.basename(fpath), streams)
+        finally:
+            _discard_restore(restore_dir)
 
 
-def push_saved_data_to_qa(fname=None):
+def push_saved_data_to_qa(fname=None, mode=None, role=None):
     """Push a saved data file to QA
+
+    mode is serial, parallel (all QA hosts at once) or tree (the data host
+    sends the file once and the QA hosts pass it on to each other). QA
+    hosts use their previous copy as the basis of the transfer.
     """
+    if mode is None:
+        mode = api.env.qa_push_mode
     qa_path = os.path.join(api.env.base_qa_path, api.env.project_name, 'var')
-    for data_host in api.env.data_hosts:
+    data_host, fname = _find_saved_data(fname, 'push', role)
+    with api.settings(host_string=data_host):
+        fpath, restore_dir = _materialize_archive(fname)
+        fname = os.path.basename(fpath)
+        size = _remote_size(fpath)
+    try:
+        timings = _fan_out(data_host, fpath, api.env.qa_hosts, qa_path,
+                           mode)
+    finally:
         with api.settings(host_string=data_host):
-            if fname is None:
-                fname = _get_data_fname('push')
-            fpath = os.path.join(_get_data_path(), fname)
-            for qa_host in api.env.qa_hosts:
-                with api.settings(host_string=qa_host, warn_only=True):
-                    cmd = 'scp %s:%s %s' % (data_host, fpath, qa_path)
-                    _sshagent_run(cmd)
+            _discard_restore(restore_dir)
+    api.puts('Pushed %s (%.1f MB):' % (fname, size / 1024.0 / 1024))
+    for qa_host, seconds in timings:
+        api.puts('    %-30s %8.1fs %8.1f MB/s' % (
+            qa_host, seconds, size / 1024.0 / 1024 / max(seconds, 0.001)))
+
 
+def _get_mirror_path(host_type):
+    return os.path.join(_get_data_path(), 'mirrors', host_type)
 
-def _sync_datafs(host_type, path):
+
+def _sync_filestorage(src_host, src_path, target_path, mode):
+    """Only Data.fs is copied, the index gets rebuilt on startup
+    """
+    inplace = ''
+    if mode == 'archive':
+        # current_<role> is only written by the syncs of its role, which
+        # hold the role's lock, so update it in place
+        inplace = '--inplace '
+    return [('Data.fs', 'rsync -tz %s%s:%s/Data.fs %s/' % (
+        inplace, src_host, src_path, target_path))]
+
+
+def _sync_tree(src_host, src_path, target_path, mode):
+    return [(src_path, 'rsync -a --delete %s:%s/ %s/' % (
+        src_host, src_path, target_path))]
+
+
+def _sync_blobstorage(src_host, src_path, target_path, mode):
+    """Split the blobs over several rsync streams.
+
+    Blobs live in directories named after their oid, in both the bushy and
+    the lawn layout, so the last hex digit of the directory name divides
+    them into shards that rsync can filter on.
+    """
+    streams = max(1, min(16, int(api.env.data_blob_streams)))
+    commands = []
+    for stream in range(streams):
+        digits = ''.join([
+            digit for i, digit in enumerate('0123456789abcdef')
+            if i % streams == stream])
+        includes = '--include="*/" --include="0x*[%s]/*"' % digits
+        if stream == 0:
+            includes = '--include="/.layout" ' + includes
+        commands.append((
+            '%s (%s/%s)' % (src_path, stream + 1, streams),
+            'rsync -a -m --delete %s --exclude="*" %s:%s/ %s/' % (
+                includes, src_host, src_path, target_path)))
+    return commands
+
+
+# The data that sync_data can copy, by name. The path is relative to the
+# buildout and sync returns the (label, command) pairs that copy it into
+# the target directory on the data host. The commands for all components
+# run at the same time. Add entries here to sync other data.
+DATA_COMPONENTS = {
+    'filestorage': {'path': 'var/filestorage', 'sync': _sync_filestorage},
+    'blobstorage': {'path': 'var/blobstorage', 'sync': _sync_blobstorage},
+    'solr': {'path': 'var/solr', 'sync': _sync_tree},
+}
+DATA_TYPE_ALIASES = {
+    'Data.fs': ['filestorage'],
+}
+
+
+def _get_components(data_type):
+    """Turn a comma separated list of data types into component names
+    """
+    if data_type == 'all':
+        return sorted(DATA_COMPONENTS)
+    components = []
+    for name in data_type.split(','):
+        name = name.strip()
+        for component in DATA_TYPE_ALIASES.get(name, [name]):
+            if component not in DATA_COMPONENTS:
+                api.abort('Unknown data_type "%s", use one of: %s' % (
+                    component, ', '.join(['all'] + sorted(DATA_COMPONENTS))))
+            if component not in components:
+                components.append(component)
+    return components
+
+
+def _run_on_data_host(command):
+    label, command, data_host = command
+    rc, output = _local_run(_sshagent_command(command, data_host))
+    return label, rc, output
+
+
+def _transfer_components(components, src_host, project_path, target_path,
+                         mode):
+    """Copy the components from the current host into
+    target_path/<component> on the data host, all at once
+    """
+    data_host = api.env.data_hosts[0]
+    commands = []
+    with api.settings(host_string=data_host):
+        for component in components:
+            info = DATA_COMPONENTS[component]
+            component_target = os.path.join(target_path, component)
+            _quiet_remote_mkdir(component_target)
+            src_path = os.path.join(project_path, info['path'])
+            for label, command in info['sync'](src_host, src_path,
+                                               component_target, mode):
+                api.puts('[%s] %s: %s' % (data_host, component, label))
+                commands.append((label, command, data_host))
+    results = _run_pool(_run_on_data_host, commands,
+                        api.env.data_sync_workers)
+    failed = [(label, output) for label, rc, output in results if rc != 0]
+    for label, output in failed:
+        api.puts('Syncing %s failed:\n%s' % (label, output))
+    return not failed
+
+
+def _get_codec(codec=None):
+    if codec is None:
+        codec = api.env.data_archive_codec
+    if codec not in ARCHIVE_CODECS:
+        api.abort('Unknown codec "%s", use one of: %s' % (
+            codec, ', '.join(sorted(ARCHIVE_CODECS))))
+    return codec
+
+
+def _compress_command(codec):
+    """The command that compresses a tar stream with the configured level
+    and number of threads
+    """
+    info = ARCHIVE_CODECS[codec]
+    if info['compress'] is None:
+        return None
+    level = api.env.data_archive_level or info['level']
+    threads = info.get('default_threads', '')
+    if 'threads' in info and int(api.env.data_archive_threads):
+        threads = info['threads'] % int(api.env.data_archive_threads)
+    return info['compress'] % locals()
+
+
+def _next_sequence(numbers):
+    """One past the highest sequence number in use. Counting the names
+    isn't enough, pruning leaves gaps and a name still in use would be
+    handed out again.
+    """
+    return max([0] + numbers) + 1
+
+
+def _archive_name(host_type, today, codec):
+    """The next free archive name for today, call this on the data host
+    """
+    filename_test = 'Data.fs-%s-%s-%s-*' % (api.env.project_name,
+                                            host_type,
+                                            today)
+    result = _quiet_remote_ls(_get_data_path(), filename_test)
+    archive_re = _archive_name_re(re.escape(host_type))
+    numbers = []
+    # the checksum manifests match the pattern too, the expression doesn't
+    for name in result.succeeded and result.split() or []:
+        match = archive_re.match(name)
+        if match is not None and match.group(2) == today:
+            numbers.append(int(match.group(3)))
+    return 'Data.fs-%s-%s-%s-%02d%s' % (api.env.project_name,
+                                        host_type,
+                                        today,
+                                        _next_sequence(numbers),
+                                        ARCHIVE_CODECS[codec]['extension'])
+
+
+def _archive_name_re(role=r'[^-]+'):
+    """A regular expression matching the archive names of the project,
+    its groups are the role, date, sequence number and extension
+    """
+    extensions = '|'.join(set([
+        re.escape(codec['extension']) for codec in ARCHIVE_CODECS.values()]))
+    return re.compile(r'^Data\.fs-%s-(%s)-(\d{4}-\d\d-\d\d)-(\d+)(%s)$' % (
+        re.escape(api.env.project_name), role, extensions))
+
+
+def _report_archive(path, codec, start):
+    with api.settings(api.hide('running', 'stdout'), warn_only=True):
+        size = api.run('wc -c < %s' % path).strip()
+    if size.isdigit():
+        size = '%.1f MB' % (int(size) / 1024.0 / 1024)
+    api.puts('Archived %s with %s in %.1fs (%s)' % (
+        os.path.basename(path), codec, time.time() - start, size))
+
+
+def _create_archive(source_dir, path, codec, tar_options=''):
+    """Archive the Data.fs in source_dir to path, call this on the data host
+    """
+    start = time.time()
+    if ARCHIVE_CODECS[codec].get('chunked'):
+        result = _store_chunks(os.path.join(source_dir, 'Data.fs'), path,
+                               _get_chunk_dir(_get_data_path()))
+        if result.succeeded:
+            api.puts('Stored %s in the chunk store in %.1fs' % (
+                os.path.basename(path), time.time() - start))
+        return result
+    compress = _compress_command(codec)
+    tmp_path = '%s.part' % path
+    with api.cd(source_dir):
+        if compress is None:
+            result = api.run('tar cf %s %s Data.fs' % (tmp_path,
+                                                       tar_options))
+        else:
+            # without pipefail a failing tar goes unnoticed
+            result = api.run(
+                'set -o pipefail; tar cf - %s Data.fs | %s > %s' % (
+                    tar_options, compress, tmp_path))
+    if result.failed:
+        api.run('rm -f %s' % tmp_path)
+        return result
+    result = api.run('mv %s %s' % (tmp_path, path))
+    _report_archive(path, codec, start)
+    _write_checksum(path)
+    return result
+
+
+def _stream_archive(src_host, src_path, path, codec):
+    """Archive the Data.fs straight from the source host while it is
+    transferred, call this on the data host
+    """
+    start = time.time()
+    compress = _compress_command(codec) or 'cat'
+    tmp_path = '%s.part' % path
+    # a dropped connection has to fail the archive, not truncate it
+    result = _sshagent_run(
+        'set -o pipefail; ssh %s "cd %s && tar cf - Data.fs" | %s > %s' % (
+            src_host, src_path, compress, tmp_path))
+    if result.failed:
+        api.run('rm -f %s' % tmp_path)
+        return result
+    result = api.run('mv %s %s' % (tmp_path, path))
+    _report_archive(path, codec, start)
+    _write_checksum(path)
+    return result
+
+
+def _archive_datafs(host_type, components, project_path, codec):
     data_host = api.env.data_hosts[0]
-    src_path = os.path.join(path, 'var', 'filestorage', 'Data.fs')
-    src_host_string = ':'.join([api.env.host_string, src_path])
     target_path = os.path.join(api.env.base_data_path,
                                api.env.project_name,
-                               'data', 'current_prod')
+                               'data', 'current_%s' % host_type)
     today = datetime.date.today().strftime('%Y-%m-%d')
-    filename_test = 'Data.fs-%s-%s-%s-*.tgz' % (api.env.project_name,
-                                                host_type,
-                                                today)
+    stream = (api.env.data_archive_stream and 'filestorage' in components and
+              not ARCHIVE_CODECS[codec].get('chunked'))
+    to_transfer = components
+    if stream:
+        to_transfer = [
+            component for component in components
+            if component != 'filestorage']
+    if to_transfer and not _transfer_components(
+      to_transfer, api.env.host_string, project_path, target_path,
+      'archive'):
+        api.abort('Syncing the %s data failed' % host_type)
+    if 'filestorage' not in components:
+        return
+    src_host = api.env.host_string
+    with api.settings(host_string=data_host):
+        filename = os.path.join(_get_data_path(),
+                                _archive_name(host_type, today, codec))
+        if stream:
+            src_path = os.path.join(project_path,
+                                    DATA_COMPONENTS['filestorage']['path'])
+            result = _stream_archive(src_host, src_path, filename, codec)
+        else:
+            result = _create_archive(
+                os.path.join(target_path, 'filestorage'), filename, codec)
+        if result.succeeded:
+            _catalog_archive(filename, host_type, today, src_host, codec)
+    if result.failed:
+        api.abort('Archiving the %s Data.fs failed' % host_type)
+
+
+def _materialize_archive(fname):
+    """Turn an archive from the chunk store into a .tar in a directory of
+    its own, call this on the data host. Returns the path of the archive to
+    send and that directory, which _discard_restore removes once the
+    archive was sent. Other archives are sent as they are and have no
+    directory.
+    """
+    data_path = _get_data_path()
+    extension = ARCHIVE_CODECS['chunks']['extension']
+    if not fname.endswith(extension):
+        return os.path.join(data_path, fname), None
+    tar_fname = fname[:-len(extension)] + ARCHIVE_CODECS['none']['extension']
+    # every retrieval gets its own directory, so they don't get in each
+    # other's way
+    restore_dir = os.path.join(data_path, '.restore-%s-%s' % (
+        fname, os.urandom(4).encode('hex')))
+    tar_path = os.path.join(restore_dir, tar_fname)
+    api.run('mkdir -p %s' % restore_dir)
+    datafs = os.path.join(restore_dir, 'Data.fs')
+    recipe = os.path.join(data_path, fname)
+    result = _restore_chunks(recipe, datafs, _get_chunk_dir(data_path))
+    if result.succeeded:
+        # the same archive has to come out every time, or a resumed
+        # download mixes two tars and the local copy never matches
+        result = api.run('chmod 644 %s && %s' % (
+            datafs, _archive_time_command(fname, recipe, datafs)))
+    if result.succeeded:
+        result = _create_archive(restore_dir, tar_path, 'none',
+                                 TAR_FIXED_OWNER)
+    api.run('rm -f %s' % datafs)
+    if result.failed:
+        _discard_restore(restore_dir)
+        api.abort("Couldn't restore %s from the chunk store" % fname)
+    return tar_path, restore_dir
+
+
+def _archive_time_command(fname, recipe, path):
+    """The command that gives the restored file the time the archive was
+    made, from the catalog or else from the recipe
+    """
+    for entry in _read_catalog() or []:
+        if entry['name'] == fname:
+            stamp = time.strftime('%Y%m%d%H%M.%S',
+                                  time.gmtime(entry['timestamp']))
+            return 'TZ=UTC touch -t %s %s' % (stamp, path)
+    return 'touch -r %s %s' % (recipe, path)
+
+
+def _discard_restore(restore_dir):
+    """Remove an archive restored from the chunk store, call this on the
+    data host
+    """
+    if restore_dir is not None:
+        api.run('rm -rf %s' % restore_dir)
+
+
+def _mirror_datafs(host_type, components, project_path):
+    """Sync into a new dated snapshot of the mirror for this role.
+
+    The snapshot starts out as hard links to the previous one. rsync
+    replaces the files that changed instead of writing into them, using the
+    old copy as the basis for the transfer, so only the changes go over the
+    network and the older snapshots keep their data.
+    """
+    data_host = api.env.data_hosts[0]
+    mirror_path = _get_mirror_path(host_type)
+    latest = os.path.join(mirror_path, 'latest')
+    today = datetime.date.today().strftime('%Y-%m-%d')
+    with api.settings(host_string=data_host):
+        (mkdir_rc, mkdir_output), (ls_rc, ls_output), (latest_rc, _) = \
+            _remote_batch(['mkdir -p %s' % mirror_path,
+                           'cd %s && ls -d %s-*' % (mirror_path, today),
+                           'test -e %s' % latest],
+                          use_sudo=True)
+        if mkdir_rc != 0:
+            api.abort("Couldn't create %s:\n%s" % (mirror_path,
+                                                    mkdir_output))
+        numbers = []
+        for name in ls_rc == 0 and ls_output.split() or []:
+            match = SNAPSHOT_RE.match(name)
+            if match is not None and match.group(1) == today:
+                numbers.append(int(match.group(2)))
+        snapshot = os.path.join(mirror_path, '%s-%02d' % (
+            today, _next_sequence(numbers)))
+        if latest_rc == 0:
+            api.run('rsync -a --link-dest=%s/ %s/ %s/' % (latest, latest,
+                                                          snapshot))
+    if not _transfer_components(components, api.env.host_string,
+                                project_path, snapshot, 'mirror'):
+        with api.settings(host_string=data_host):
+            api.run('rm -rf %s' % snapshot)
+        api.abort('Syncing the %s data into %s failed' % (host_type,
+                                                          snapshot))
+    with api.settings(host_string=data_host):
+        api.run('ln -sfn %s %s' % (snapshot, latest))
+    api.puts('Synced %s into %s' % (', '.join(components), snapshot))
+
+
+def _probe_lock_command(lock_path):
+    """Print the inode of the lock directory and its owner line. Without
+    an owner file, e.g. when the owner died right after taking the lock,
+    the time of the directory stands in for when it was taken.
+    """
+    return ('echo $(ls -di %(lock_path)s | awk \'{print $1}\') '
+            '"$(grep . %(lock_path)s/owner 2>/dev/null || '
+            'echo "$(stat -c %%Y %(lock_path)s 2>/dev/null || '
+            'stat -f %%m %(lock_path)s) unknown")"' % locals())
+
+
+def _take_over_lock_command(lock_path, inode, since, holder):
+    """Move a stale lock out of the way. The claim is named after the lock
+    we saw, so only one waiter gets to take it over, and the lock is put
+    back when it turns out to be a new one by then. Inodes get reused, so
+    the owner line has to match as well.
+    """
+    claim_path = '%s.stale-%s-%s' % (lock_path, inode, since)
+    seen = '%s unknown' % inode
+    if holder != 'unknown':
+        seen = '%s %s %s' % (inode, since, holder)
+    return ('mkdir %(claim_path)s && mv %(lock_path)s %(claim_path)s/lock && '
+            'if [ "$(ls -di %(claim_path)s/lock | awk \'{print $1}\') '
+            '$(grep . %(claim_path)s/lock/owner 2>/dev/null || '
+            'echo unknown)" = "%(seen)s" ]; then rm -rf %(claim_path)s; else '
+            'mv %(claim_path)s/lock %(lock_path)s; rmdir %(claim_path)s; '
+            'false; fi' % locals())
+
+
+def _acquire_data_lock(role, owner):
+    """Take the lock for syncing a role on the data host, waiting while
+    another sync holds it. Locks older than data_lock_timeout are taken
+    over. Returns the data host's time when we started waiting and the
+    contents of the stamp of the last finished sync.
+    """
+    data_path = _get_data_path()
+    lock_path = os.path.join(data_path, '.lock-%s' % role)
+    stamp_path = os.path.join(data_path, '.last-sync-%s' % role)
+    started = None
+    while True:
+        (now_rc, now), (lock_rc, holder), (stamp_rc, stamp) = _remote_batch([
+            'date +%s',
+            'mkdir -p %s && mkdir %s 2>/dev/null && '
+            'echo "$(date +%%s) %s" > %s/owner && echo acquired || %s' % (
+                data_path, lock_path, owner, lock_path,
+                _probe_lock_command(lock_path)),
+            'cat %s' % stamp_path])
+        now = int(now.strip())
+        if started is None:
+            started = now
+        if holder.strip() == 'acquired':
+            return started, stamp_rc == 0 and stamp.strip() or ''
+        holder_parts = holder.split(None, 2)
+        if len(holder_parts) < 2 or not holder_parts[1].isdigit():
+            # the lock went away in between, try again
+            time.sleep(1)
+            continue
+        inode, since = holder_parts[0], int(holder_parts[1])
+        holder = holder_parts[2:] and holder_parts[2] or 'unknown'
+        if now - since > int(api.env.data_lock_timeout):
+            api.puts('Taking over the stale %s sync lock of %s' % (role,
+                                                                   holder))
+            with api.settings(api.hide('warnings'), warn_only=True):
+                api.run(_take_over_lock_command(lock_path, inode, since,
+                                                holder))
+            continue
+        api.puts('Waiting for the %s sync of %s (running for %ss)' % (
+            role, holder, now - since))
+        time.sleep(int(api.env.data_lock_poll))
+
+
+def _release_data_lock(role, stamp=None):
+    """Release the sync lock, recording the finished sync in the stamp
+    """
     data_path = _get_data_path()
-    result = _quiet_remote_ls(data_path, filename_test)
-    existing_files = result.split()
-    filename = 'Data.fs-%s-%s-%s-%02d.tgz' % (api.env.project_name,
-                                              host_type,
-                                              today,
-                                              len(existing_files)+1)
-    # Ensure the `current_prod` dir exists
-    result = _quiet_remote_mkdir(target_path)
+    commands = []
+    if stamp is not None:
+        commands.append('echo "$(date +%%s) %s" > %s' % (
+            stamp, os.path.join(data_path, '.last-sync-%s' % role)))
+    commands.append('rm -rf %s' % os.path.join(data_path, '.lock-%s' % role))
+    _remote_batch(commands)
+
+
+def _lock_owner():
+    return '%s@%s:%s' % (getpass.getuser(), socket.gethostname(),
+                         os.getpid())
+
+
+def export_saved_data(role='prod', snapshot='latest', codec=None):
+    """Create a Data.fs archive from a mirrored snapshot
+    """
+    codec = _get_codec(codec)
+    data_host = api.env.data_hosts[0]
+    filestorage_path = os.path.join(_get_mirror_path(role), snapshot,
+                                    'filestorage')
+    today = datetime.date.today().strftime('%Y-%m-%d')
     with api.settings(host_string=data_host):
-        _sshagent_run('rsync -z --inplace %s %s' % (src_host_string,
-                                                   target_path))
-        with api.cd(target_path):
-            result = api.run('tar czf %s Data.fs' % filename)
+        if not contrib.files.exists(
+          os.path.join(filestorage_path, 'Data.fs')):
+            api.abort('There is no Data.fs in %s' % filestorage_path)
+        # the lock makes the sequence number in the name safe to use
+        _acquire_data_lock(role, _lock_owner())
+        try:
+            filename = os.path.join(_get_data_path(),
+                                    _archive_name(role, today, codec))
+            result = _create_archive(filestorage_path, filename, codec)
             if result.succeeded:
-                api.run('mv %s ..' % filename)
-            else:
-                api.run('rm -f %s' % filename)
+                _catalog_archive(filename, role, today,
+                                 '%s:%s' % (data_host, filestorage_path),
+                                 codec)
+        finally:
+            _release_data_lock(role)
+        if result.succeeded:
+            api.puts('Exported %s' % filename)
 
 
-def sync_data(role='prod', data_type='Data.fs'):
+def sync_data(role='prod', data_type='Data.fs', mode=None, codec=None):
     """Retrieve a set of data from either prod or staging.
+
+    data_type is a comma separated list of filestorage (or Data.fs),
+    blobstorage and solr, or "all". mode is either "archive", which keeps an
+    archive of Data.fs for every sync, or "mirror", which keeps dated rsync
+    snapshots per role. codec is one of gzip, pigz, zstd or none.
     """
     # Basic sanity checks
     if role not in ['prod', 'staging']:
         api.abort('Role must be either "prod" or "staging".')
-    if data_type != 'Data.fs':
-        api.abort('The only supported data_type is "Data.fs".')
+    components = _get_components(data_type)
+    if mode is None:
+        mode = api.env.data_sync_mode
+    if mode not in ['archive', 'mirror']:
+        api.abort('Mode must be either "archive" or "mirror".')
+    codec = _get_codec(codec)
 
-    api.puts('Retrieving the %s for %s' % (data_type, role))
+    api.puts('Retrieving the %s for %s' % (', '.join(components), role))
 
     hosts = api.env.get('%s_hosts' % role)
     base_path = api.env.get('base_%s_path' % role)
     project_path = os.path.join(base_path,
                                 api.env.project_name)
-    for host in hosts:
+    # Only one sync per role runs at a time. If another one finished while
+    # we waited and it synced the same data, there is no need to sync again.
+    data_host = api.env.data_hosts[0]
+    stamp = '%s %s' % (mode, ','.join(components))
+    with api.settings(host_string=data_host):
+        started, last_sync = _acquire_data_lock(role, _lock_owner())
+    finished = False
+    try:
+        last_sync = last_sync.split()
+        if (len(last_sync) == 3 and int(last_sync[0]) >= started and
+          last_sync[1] == mode and
+          set(components) <= set(last_sync[2].split(','))):
+            api.puts('Using the %s sync that finished while waiting' % role)
+            return
+        for host in hosts:
+            with api.settings(host_string=host):
+                if mode == 'mirror':
+                    _mirror_datafs(role, components, project_path)
+                else:
+                    _archive_datafs(role, components, project_path, codec)
+        finished = True
+    finally:
+        with api.settings(host_string=data_host):
+            _release_data_lock(role, finished and stamp or None)
+
+
+def _retained(entries, policy):
+    """The keys of the entries the retention policy keeps. entries are
+    (date, sequence, key) tuples and policy is how many days, weeks and
+    months to keep the newest entry of.
+    """
+    periods = [lambda day: day,
+               lambda day: day.isocalendar()[:2],
+               lambda day: (day.year, day.month)]
+    entries = sorted(entries, reverse=True)
+    keep = set()
+    for count, period in zip(policy, periods):
+        seen = []
+        for date, sequence, key in entries:
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            if period(day) in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.append(period(day))
+            keep.add(key)
+    return keep
+
+
+def _prune_plan(role, policy):
+    """The archives and mirror snapshots of a role the policy doesn't
+    keep, call this on the data host
+    """
+    data_path = _get_data_path()
+    mirror_path = _get_mirror_path(role)
+    (ls_rc, archives), (snap_rc, snapshots), (latest_rc, latest) = \
+        _remote_batch([
+            'cd %s && ls Data.fs-%s-%s-*' % (data_path, api.env.project_name,
+                                             role),
+            'cd %s && ls -d ????-??-??-*' % mirror_path,
+            'readlink %s' % os.path.join(mirror_path, 'latest')])
+    archive_re = _archive_name_re(re.escape(role))
+    # an archive and its checksum manifest go together
+    archive_paths = {}
+    entries = []
+    for name in ls_rc == 0 and archives.split() or []:
+        match = archive_re.match(name)
+        if match is None:
+            continue
+        date, sequence = match.group(2), int(match.group(3))
+        if (date, sequence) not in archive_paths:
+            archive_paths[(date, sequence)] = []
+            entries.append((date, sequence, (date, sequence)))
+        path = os.path.join(data_path, name)
+        archive_paths[(date, sequence)].extend([path, '%s.sha256' % path])
+    keep = _retained(entries, policy)
+    remove = []
+    for key in sorted(archive_paths):
+        if key not in keep:
+            remove.extend(archive_paths[key])
+
+    latest = latest_rc == 0 and os.path.basename(latest.strip()) or None
+    entries = []
+    for name in snap_rc == 0 and snapshots.split() or []:
+        match = SNAPSHOT_RE.match(name)
+        if match is not None:
+            entries.append((match.group(1), int(match.group(2)), name))
+    keep = _retained(entries, policy)
+    for date, sequence, name in sorted(entries):
+        if name not in keep and name != latest:
+            remove.append(os.path.join(mirror_path, name))
+    return remove
+
+
+def prune_saved_data(role=None, daily=None, weekly=None, monthly=None,
+                     dry_run='false'):
+    """Remove the saved data the retention policy doesn't keep
+
+    For each role the newest archive and mirror snapshot of the last
+    `daily` days, `weekly` weeks and `monthly` months that have one are
+    kept. Chunks that no archive uses anymore are removed from the chunk
+    store.
+    """
+    policy = [daily, weekly, monthly]
+    for i, (value, name) in enumerate(zip(policy, ['daily', 'weekly',
+                                                   'monthly'])):
+        if value is None:
+            value = api.env.get('data_keep_%s' % name)
+        policy[i] = int(value)
+    roles = role and [role] or ['prod', 'staging']
+    data_host = api.env.data_hosts[0]
+    hide_levels = ['running', 'stdout']
+    with api.settings(api.hide(*hide_levels), host_string=data_host):
+        plans = [(role, _prune_plan(role, policy)) for role in roles]
+    if not [paths for role, paths in plans if paths]:
+        api.puts('Nothing to prune')
+        return
+    for role, paths in plans:
+        api.puts('%s:\n\t%s' % (role, '\n\t'.join(
+            [path for path in paths if not path.endswith('.sha256')] or
+            ['nothing to remove'])))
+    if dry_run.lower() in TRUISMS or \
+      not contrib.console.confirm('Remove these files?', default=False):
+        return
+    with api.settings(host_string=data_host):
+        owner = _lock_owner()
+        for role, paths in plans:
+            if not paths:
+                continue
+            # the lock keeps a sync from numbering an archive after one
+            # that is removed
+            _acquire_data_lock(role, owner)
+            try:
+                api.run('rm -rf %s' % ' '.join(paths))
+                _append_catalog([
+                    {'name': os.path.basename(path), 'removed': True}
+                    for path in paths
+                    if os.path.dirname(path) == _get_data_path() and
+                    not path.endswith('.sha256')])
+            finally:
+                _release_data_lock(role)
+        _collect_chunks(_get_data_path())
+
+
+def index_saved_data():
+    """Bring the catalogs on the data servers up to date with the archives
+    that are there, for archives made before there was a catalog
+    """
+    archive_re = _archive_name_re()
+    codecs = {}
+    for name in sorted(ARCHIVE_CODECS, reverse=True):
+        codecs[ARCHIVE_CODECS[name]['extension']] = name
+    data_path = _get_data_path()
+    for host in api.env.data_hosts:
         with api.settings(host_string=host):
-            if data_type == 'Data.fs':
-                _sync_datafs(role, project_path)
+            result = _quiet_remote_ls(data_path, _archive_filter())
+            # ls fails when one of the patterns matches nothing
+            names = result.split()
+            cataloged = [entry['name'] for entry in _read_catalog() or []]
+            for name in names:
+                match = archive_re.match(name)
+                if match is None or name in cataloged:
+                    continue
+                role, date, sequence, extension = match.groups()
+                path = os.path.join(data_path, name)
+                if not contrib.files.exists('%s.sha256' % path):
+                    _write_checksum(path)
+                # order the archives by their name
+                timestamp = calendar.timegm(
+                    time.strptime(date, '%Y-%m-%d')) + int(sequence)
+                _catalog_archive(path, role, date, 'unknown',
+                                 codecs[extension], timestamp)
+                api.puts('Added %s to the catalog' % name)
+            removed = [name for name in cataloged if name not in names]
+            if removed:
+                _append_catalog([{'name': name, 'removed': True}
+                                 for name in removed])
+                api.puts('Removed %s from the catalog' % ', '.join(removed))
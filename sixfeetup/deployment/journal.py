@@ -0,0 +1,27 @@
+import json
+import os
+
+
+def _read_journal(path):
+    """Read the entries of a journal, oldest first. A line that was cut
+    short by a crash is skipped.
+    """
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def _append_journal(path, entry):
+    """Add an entry to a journal, making sure it is on disk before going on
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,87 @@
+import Queue
+import sys
+from multiprocessing.pool import ThreadPool
+
+QUEUE_TIMEOUT = 60 * 60 * 24 * 365
+
+
+def _run_pool(func, items, workers):
+    """Call `func` for every item on a bounded thread pool.
+
+    The results are returned in the same order as `items`. Any exception
+    raised by `func` is re-raised in the calling thread.
+    """
+    items = list(items)
+    workers = int(workers)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _run_graph(nodes, dependencies, func, workers, on_done=None):
+    """Call `func` for every node on a bounded thread pool, starting a node
+    only after all the nodes it depends on have finished.
+
+    `dependencies` maps a node to the nodes it depends on, dependencies that
+    aren't in `nodes` are ignored. `on_done(node, result)` is called in the
+    calling thread as each node finishes. After an error no new nodes are
+    started, the running ones are finished and the first error is re-raised.
+    Returns a dict of the results by node.
+    """
+    nodes = list(nodes)
+    node_set = set(nodes)
+    waiting = {}
+    for node in nodes:
+        waiting[node] = (set(dependencies.get(node, ())) & node_set) - \
+            set([node])
+    finished = Queue.Queue()
+    pool = ThreadPool(max(1, min(int(workers), len(nodes))))
+    running = set()
+    results = {}
+    error = None
+
+    def run(node):
+        try:
+            finished.put((node, None, func(node)))
+        except BaseException:
+            finished.put((node, sys.exc_info(), None))
+
+    try:
+        while True:
+            if error is None:
+                for node in nodes:
+                    if node in waiting and not waiting[node]:
+                        del waiting[node]
+                        running.add(node)
+                        pool.apply_async(run, (node,))
+            if not running:
+                break
+            # a timeout keeps the wait interruptible with ctrl-c
+            node, exc_info, result = finished.get(True, QUEUE_TIMEOUT)
+            running.discard(node)
+            try:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if on_done is not None:
+                    on_done(node, result)
+            except BaseException:
+                if error is None:
+                    error = sys.exc_info()
+                continue
+            results[node] = result
+            for dependencies_left in waiting.values():
+                dependencies_left.discard(node)
+    finally:
+        pool.close()
+        pool.join()
+    if error is not None:
+        raise error[0], error[1], error[2]
+    if waiting:
+        raise ValueError("Circular dependencies between: %s" %
+                         ", ".join(map(str, sorted(waiting))))
+    return results
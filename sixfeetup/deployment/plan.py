@@ -0,0 +1,292 @@
+import ConfigParser
+import os
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from fabric import api
+from fabric import colors
+
+from jarn.mkrelease.scm import SCMFactory
+from jarn.mkrelease.setuptools import Setuptools
+
+from sixfeetup.deployment import release
+from sixfeetup.deployment.journal import _append_journal
+from sixfeetup.deployment.journal import _read_journal
+from sixfeetup.deployment.parallel import _run_graph
+from sixfeetup.deployment.utils import TRUISMS
+
+TARGET_OPTIONS = ['hosts', 'rollout', 'batch_size', 'concurrency', 'check']
+
+
+def _read_plan(path):
+    """Read a release plan, see execute_plan for the format
+    """
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(path):
+        api.abort("Couldn't read the plan %s" % path)
+    if not parser.has_section('plan'):
+        api.abort("%s has no [plan] section" % path)
+
+    def get(option, default=''):
+        if parser.has_option('plan', option):
+            return parser.get('plan', option)
+        return default
+
+    plan = {
+        'packages': get('packages').split(),
+        'targets': get('targets').split(),
+        'workers': int(get('workers', api.env.release_workers)),
+        'package_options': {},
+        'target_options': {},
+    }
+    for section in parser.sections():
+        if section.startswith('package:'):
+            package = section[len('package:'):].strip()
+            plan['package_options'][package] = dict(parser.items(section))
+        elif section.startswith('target:'):
+            target = section[len('target:'):].strip()
+            options = dict(parser.items(section))
+            unknown = set(options) - set(TARGET_OPTIONS)
+            if unknown:
+                api.abort("Unknown options for %s: %s" % (
+                    target, ", ".join(sorted(unknown))))
+            plan['target_options'][target] = options
+    with open(path) as f:
+        plan['id'] = md5(f.read()).hexdigest()
+    return plan
+
+
+def _plan_steps(plan, dependencies):
+    """The steps of a plan in order, and the steps each one needs to wait
+    for
+    """
+    steps = []
+    depends = {}
+    for package in plan['packages']:
+        depends['release:%s' % package] = [
+            'release:%s' % required
+            for required in dependencies.get(package, ())]
+        depends['bump:%s' % package] = ['release:%s' % package]
+        steps.extend(['release:%s' % package, 'bump:%s' % package])
+    depends['versions'] = [step for step in steps if step.startswith('bump:')]
+    depends['tag'] = ['versions']
+    steps.extend(['versions', 'tag'])
+    previous = 'tag'
+    for target in plan['targets']:
+        depends['deploy:%s' % target] = [previous]
+        previous = 'deploy:%s' % target
+        steps.append(previous)
+    return steps, depends
+
+
+def _start_run(plan, plan_path, fresh):
+    """Find the unfinished run of this plan to resume or start a new one.
+    Returns the run, its finished steps and the parts of the unfinished
+    steps that are done.
+    """
+    journal = api.env.plan_journal
+    entries = _read_journal(journal)
+    if entries and not fresh:
+        run = entries[-1]['run']
+        run_entries = [entry for entry in entries if entry['run'] == run]
+        steps = [entry['step'] for entry in run_entries]
+        if 'finished' not in steps:
+            if run_entries[0].get('plan_id') != plan['id']:
+                api.abort("The last run, of %s, didn't finish. Use "
+                          "fresh=yes to start over with this plan." %
+                          run_entries[0].get('plan'))
+            done = dict([(entry['step'], entry) for entry in run_entries
+                         if entry.get('status') == 'done'])
+            progress = {}
+            for entry in run_entries:
+                if entry.get('status') == 'progress':
+                    progress.setdefault(entry['step'], {})[
+                        entry['part']] = entry
+            print colors.yellow("Resuming run %s, %s steps are done" % (
+                run, len(done)))
+            return run, done, progress
+    run = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    _append_journal(journal, {'run': run, 'step': 'start',
+                              'plan': plan_path, 'plan_id': plan['id']})
+    return run, {}, {}
+
+
+def _journal_step(run, step, status, **info):
+    info.update({'run': run, 'step': step, 'status': status,
+                 'time': time.time()})
+    _append_journal(api.env.plan_journal, info)
+
+
+def _restore_step(step, entry):
+    """Put back what a step that finished in an earlier run left behind
+    """
+    kind, name = (step.split(':', 1) + [None])[:2]
+    if kind == 'release':
+        package_info = api.env.package_info[name]
+        package_info['version'] = entry['version']
+        package_info['released_version'] = entry['version']
+        package_info['next_version'] = entry['next_version']
+    elif kind == 'tag':
+        api.env.deploy_tag = entry['tag']
+
+
+def _run_package_step(step):
+    """Release or bump a package, this runs in a thread
+    """
+    kind, package = step.split(':', 1)
+    if kind == 'release':
+        return release._mkrelease(package)
+    return release._bump_package_version(package)
+
+
+def _run_package_steps(run, steps, depends, done, workers):
+    """Run the release and bump steps, packages that don't depend on each
+    other at the same time
+    """
+    package_steps = [step for step in steps
+                     if step.split(':')[0] in ['release', 'bump'] and
+                     step not in done]
+
+    def step_done(step, result):
+        kind, package = step.split(':', 1)
+        if kind == 'release':
+            if result.failed:
+                print result
+                release._record_failed_release(package)
+                _journal_step(run, step, 'failed', output=result.stderr)
+                api.abort("Releasing %s failed" % package)
+            release._record_release(package)
+            package_info = api.env.package_info[package]
+            done[step] = {'version': package_info['version'],
+                          'next_version': package_info['next_version']}
+        else:
+            done[step] = {'change': result}
+        _journal_step(run, step, 'done', **done[step])
+        print colors.blue("%s done" % step)
+
+    if package_steps:
+        with api.settings(warn_only=True):
+            _run_graph(package_steps, depends, _run_package_step, workers,
+                       step_done)
+
+
+def _run_step(run, plan, step, done, progress):
+    """Run one of the steps after the packages are released. The parts of
+    the versions and tag steps are journaled as they finish, so a resumed
+    run doesn't write or tag a second time.
+    """
+    print colors.blue("Running %s" % step)
+    info = {}
+    parts = progress.setdefault(step, {})
+
+    def part_done(part, **part_info):
+        parts[part] = part_info
+        _journal_step(run, step, 'progress', part=part, **part_info)
+
+    if step == 'versions':
+        if 'written' in parts:
+            changes = [tuple(change)
+                       for change in parts['written']['changes']]
+        else:
+            changes = [tuple(done[bump]['change'])
+                       for bump in sorted(done)
+                       if bump.startswith('bump:') and done[bump]['change']]
+            if plan['packages']:
+                changes.append(release._update_versions_file())
+            part_done('written', changes=changes)
+        if changes:
+            release._commit_changes(changes)
+    elif step == 'tag':
+        if 'tagged' in parts:
+            version = parts['tagged']['version']
+            api.env.deploy_tag = version
+        else:
+            version = release._create_buildout_tag()
+            part_done('tagged', version=version)
+        if 'written' in parts:
+            change = tuple(parts['written']['change'])
+        else:
+            change = release._bump_buildout_version(version)
+            part_done('written', change=change)
+        release._commit_changes([change])
+        info['tag'] = version
+    else:
+        target = step.split(':', 1)[1]
+        options = dict(plan['target_options'].get(target, {}))
+        if 'hosts' in options:
+            api.env['%s_hosts' % target] = options.pop('hosts').split()
+        release.release_to(target, confirm='no', **options)
+    done[step] = info
+    _journal_step(run, step, 'done', **info)
+
+
+def execute_plan(plan='release.cfg', fresh='no', interactive='no'):
+    """Release and deploy as described by a plan file
+
+    The plan is an ini file:
+
+        [plan]
+        packages = my.package my.other.package
+        targets = testing staging
+        workers = 4
+
+        [package:my.package]
+        target = private
+
+        [target:staging]
+        hosts = staging01 staging02
+        rollout = batch
+        batch_size = 1
+
+    Packages are released at the same time when they don't require each
+    other. Every finished step is written to the plan journal, so running
+    the same plan again after a failure carries on with the step that
+    failed. Use fresh=yes to start over. Unless interactive=yes anything
+    that would prompt aborts instead, so plans can run without anyone at
+    the terminal.
+    """
+    plan_path = plan
+    plan = _read_plan(plan_path)
+    fresh = fresh.lower() in TRUISMS
+    interactive = interactive.lower() in TRUISMS
+    with api.settings(abort_on_prompts=not interactive):
+        api.env.scm_factory = SCMFactory()
+        api.env.setuptools = Setuptools()
+        release.list_package_candidates(verbose='no')
+        missing = [package for package in plan['packages']
+                   if package not in api.env.package_info]
+        if missing:
+            api.abort("Not in the package dirs: %s" % ", ".join(missing))
+        api.env.to_release = list(plan['packages'])
+        for package in plan['packages']:
+            api.env.package_info[package]['release'] = True
+            api.env.package_info[package].update(
+                plan['package_options'].get(package, {}))
+
+        run, done, progress = _start_run(plan, plan_path, fresh)
+        # a resumed run shares its release journal entries with the first
+        # attempt, so rollback_release undoes both
+        release._journal_run = run
+        for step, entry in done.items():
+            _restore_step(step, entry)
+        dependencies = {}
+        if len(plan['packages']) > 1:
+            dependencies = release._release_dependencies(plan['packages'])
+        steps, depends = _plan_steps(plan, dependencies)
+        _run_package_steps(run, steps, depends, done, plan['workers'])
+        # the rest works on the buildout checkout and the hosts, one step
+        # after the other
+        for step in steps:
+            if step in done or step.split(':')[0] in ['release', 'bump']:
+                continue
+            try:
+                _run_step(run, plan, step, done, progress)
+            except BaseException:
+                _journal_step(run, step, 'failed')
+                raise
+        _journal_step(run, 'finished', 'done')
+    print colors.blue("Plan %s is done" % plan_path)
@@ -1,6 +1,14 @@
+import fnmatch
+import glob
+import multiprocessing
 import os
-import pickle
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import pkg_resources
 
 from fabric import colors
@@ -10,9 +18,24 @@ from fabric import contrib
 from jarn.mkrelease.scm import SCMFactory
 from jarn.mkrelease.setuptools import Setuptools
 
+from sixfeetup.deployment.cache import _file_signature
+from sixfeetup.deployment.cache import _load_cache
+from sixfeetup.deployment.cache import _save_cache
+from sixfeetup.deployment.journal import _append_journal
+from sixfeetup.deployment.journal import _read_journal
+from sixfeetup.deployment.parallel import _run_graph
+from sixfeetup.deployment.parallel import _run_pool
+from sixfeetup.deployment.state import _read_state
+from sixfeetup.deployment.state import _record_state
 from sixfeetup.deployment.utils import GLOBAL_IGNORES
 from sixfeetup.deployment.utils import TRUISMS
 from sixfeetup.deployment.utils import YES_OR_NO
+from sixfeetup.deployment.utils import _remote_batch
+from sixfeetup.deployment.versions import _get_pins
+from sixfeetup.deployment.versions import _read_versions
+from sixfeetup.deployment.versions import _update_pins
+from sixfeetup.deployment.versions import _write_versions
+from sixfeetup.deployment.warmup import _warm_up
 
 PASS_ME = ['none', 'skip', 's']
 SETUPPY_VERSION = r"""(version.*=.*['"])(.*)(['"])"""
@@ -37,6 +60,45 @@ DEFAULT_PATHS = {
     'testing': '/var/db/zope/dev',
     'staging': '/var/db/zope',
 }
+ROLLOUTS = ['serial', 'all', 'batch', 'canary']
+# supervisor states of processes that are down without being stopped
+SUPERVISOR_FAILED_STATES = ['FATAL', 'BACKOFF', 'EXITED', 'UNKNOWN']
+PIN_RE = re.compile(r'^\s*([A-Za-z0-9_.\-]+)\s*=\s*(\S+)(\s+[#;].*)?\s*$')
+# tags per working copy, loaded from api.env.tag_index on first use
+_tag_index = None
+_tag_index_lock = threading.Lock()
+# (sandbox, files, name, version) of the changes waiting to be committed
+_pending_commits = []
+# this run's entries in the release journal, see _record_effect
+_journal_run = None
+_journal_count = [0]
+_journal_lock = threading.Lock()
+
+
+def _record_effect(action, **info):
+    """Write a side effect of the release to the release journal so
+    rollback_release can undo it. This may be called from threads.
+    """
+    global _journal_run
+    if not api.env.release_journal:
+        return
+    with _journal_lock:
+        if _journal_run is None:
+            _journal_run = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'),
+                                      os.getpid())
+        elif not _journal_count[0]:
+            # a resumed plan carries on with the ids of its first attempt
+            _journal_count[0] = len([
+                entry for entry in _read_journal(api.env.release_journal)
+                if entry.get('run') == _journal_run and 'id' in entry])
+        _journal_count[0] += 1
+        info.update({
+            'run': _journal_run,
+            'id': '%s-%s' % (_journal_run, _journal_count[0]),
+            'action': action,
+            'time': time.time(),
+        })
+        _append_journal(api.env.release_journal, info)
 
 
 def deploy(env='testing', diffs='on'):
@@ -48,7 +110,7 @@ def deploy(env='testing', diffs='on'):
         api.env.setuptools = Setuptools()
         choose_packages(diffs, save_choices='yes')
         release_packages(save_choices='yes')
-        bump_package_versions()
+        bump_package_versions(commit='no')
         update_versions_cfg()
         tag_buildout()
         #TODO: get automated release working
@@ -74,11 +136,97 @@ Check the following URL before continuing:
     api.prompt("Press return to continue")
 
 
-def list_package_candidates(verbose='yes'):
+def _get_package_info(package_path):
+    """Get the package name and version via mkrelease.
+
+    This is a module level function so that it can be handed to a process
+    pool. Returns None when mkrelease gives up on the package.
+    """
+    # TODO: handle dev release
+    try:
+        return api.env.setuptools.get_package_info(package_path,
+                                                   develop=False)
+    except SystemExit:
+        # mkrelease exits on a broken setup.py, which would kill the pool
+        # worker and leave the pool waiting for its result forever
+        return None
+
+
+def _package_signature(package_path, info=None):
+    """The state of the files the name and version are read from. The
+    version file configured for the package, known once it was read
+    before, is part of it as bump_package_versions edits it.
+    """
+    paths = [os.path.join(package_path, 'setup.py'),
+             os.path.join(package_path, 'setup.cfg')]
+    version_location = api.env.default_version_location
+    if info is not None:
+        package_info = api.env.package_info.get(
+            pkg_resources.safe_name(info[0]), {})
+        version_location = package_info.get('version_location',
+                                            version_location)
+    version_file = os.path.join(package_path, version_location[0])
+    if version_file not in paths:
+        paths.append(version_file)
+    return _file_signature(paths)
+
+
+def _discover_packages(package_paths, processes=1):
+    """Return the (name, version) of each package path, in order.
+
+    Packages whose setup.py, setup.cfg and version file haven't changed
+    since the last run are read from the package cache instead of running
+    setup.py.
+    """
+    cache_file = api.env.package_cache
+    cache = {}
+    if cache_file:
+        cache = _load_cache(cache_file)
+    signatures = {}
+    to_query = []
+    for package_path in package_paths:
+        cached = cache.get(package_path)
+        signatures[package_path] = _package_signature(
+            package_path, cached and cached['info'])
+        if cached is None or cached['signature'] != signatures[package_path]:
+            to_query.append(package_path)
+
+    if processes > 1 and len(to_query) > 1:
+        pool = multiprocessing.Pool(min(processes, len(to_query)))
+        try:
+            results = pool.map(_get_package_info, to_query)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for package_path in to_query:
+            with api.lcd(package_path):
+                results.append(_get_package_info(package_path))
+
+    failed = [package_path for package_path, info in zip(to_query, results)
+              if info is None]
+    if failed:
+        api.abort("Couldn't read the package info of %s" %
+                  ", ".join(failed))
+    for package_path, info in zip(to_query, results):
+        cache[package_path] = {
+            'signature': _package_signature(package_path, info),
+            'info': info,
+        }
+    if cache_file and to_query:
+        _save_cache(cache_file, cache)
+    return [cache[package_path]['info'] for package_path in package_paths]
+
+
+def list_package_candidates(verbose='yes', processes=None):
     """List the packages that are available for deployment"""
+    if processes is None:
+        processes = api.env.discovery_processes
+    processes = int(processes) or multiprocessing.cpu_count()
     ignore_dirs = api.env.ignore_dirs + GLOBAL_IGNORES
-    get_info = api.env.setuptools.get_package_info
     # find all the packages in the given package dirs
+    package_paths = []
     for package_dir in api.env.package_dirs:
         abs_package_dir = os.path.abspath(os.path.expanduser(package_dir))
         items = os.listdir(abs_package_dir)
@@ -88,19 +236,20 @@ def list_package_candidates(verbose='yes'):
             package_path = os.path.join(abs_package_dir, item)
             if not os.path.isdir(package_path):
                 continue
-            with api.lcd(package_path):
-                # get the actual package name and version via mkrelease
-                # TODO: handle dev release
-                pkg_name, pkg_ver = get_info(package_path, develop=False)
-            safe_pkg_name = pkg_resources.safe_name(pkg_name)
-            if safe_pkg_name != pkg_name:
-                msg = "\nSafe package name for %s used: %s"
-                print colors.yellow(msg % (pkg_name, safe_pkg_name))
-            api.env.package_info.setdefault(safe_pkg_name, {})
-            api.env.package_info[safe_pkg_name]['path'] = package_path
-            api.env.package_info[safe_pkg_name]['version'] = pkg_ver
-            api.env.package_info[safe_pkg_name]['unsafe_name'] = pkg_name
-            api.env.packages.append(safe_pkg_name)
+            package_paths.append(package_path)
+    # get the actual package names and versions via mkrelease
+    package_infos = _discover_packages(package_paths, processes)
+    for package_path, (pkg_name, pkg_ver) in zip(package_paths,
+                                                 package_infos):
+        safe_pkg_name = pkg_resources.safe_name(pkg_name)
+        if safe_pkg_name != pkg_name:
+            msg = "\nSafe package name for %s used: %s"
+            print colors.yellow(msg % (pkg_name, safe_pkg_name))
+        api.env.package_info.setdefault(safe_pkg_name, {})
+        api.env.package_info[safe_pkg_name]['path'] = package_path
+        api.env.package_info[safe_pkg_name]['version'] = pkg_ver
+        api.env.package_info[safe_pkg_name]['unsafe_name'] = pkg_name
+        api.env.packages.append(safe_pkg_name)
     if verbose.lower() in TRUISMS:
         print """
 Packages available:
@@ -109,44 +258,140 @@ Packages available:
 
 
 def _load_previous_state(save_choices):
-    """Get state info from the saved pickle
+    """Get state info from the state log
     """
+    state_file = api.env.deploy_state
     msg = "Do you want to use the previously saved choices?"
     if (save_choices and
-      os.path.exists('.saved_choices') and
+      os.path.exists(state_file) and
       contrib.console.confirm(msg)):
-        with open('.saved_choices') as f:
-            api.env.package_info = pickle.load(f)
+        packages = _read_state(state_file)
+        if packages is not None:
+            for package, package_info in packages.items():
+                api.env.package_info.setdefault(package, {}).update(
+                    package_info)
             api.env.to_release = [
                 package
                 for package in api.env.package_info
                 if api.env.package_info[package].get('release', False)]
-        return True
-    elif os.path.exists('.saved_choices'):
-        os.unlink('.saved_choices')
+            return True
+        print colors.yellow("%s can't be read, choose again" % state_file)
+    _clear_previous_state()
     return False
 
 
 def _clear_previous_state():
-    if not os.path.exists('.saved_choices'):
+    if os.path.exists(api.env.deploy_state):
+        os.unlink(api.env.deploy_state)
+
+
+def _record_choices():
+    """Save the package choices, for releasing where a failed release
+    stopped
+    """
+    for package in api.env.packages:
+        package_info = api.env.package_info[package]
+        _record_state(api.env.deploy_state, package, 'chosen',
+                      path=package_info['path'],
+                      version=package_info['version'],
+                      unsafe_name=package_info.get('unsafe_name', package),
+                      release=package_info.get('release', False))
+
+
+def show_state():
+    """Show the saved choices and what has happened to each package
+    """
+    packages = _read_state(api.env.deploy_state)
+    if not packages:
+        print colors.yellow("There is no saved state")
         return
-    os.unlink('.saved_choices')
+    for package in sorted(packages):
+        package_info = packages[package]
+        steps = sorted(package_info['steps'].items(),
+                       key=lambda step: step[1]['time'])
+        print "%-40s %-10s %s" % (
+            package, package_info.get('version', ''),
+            ", ".join(["%s %s (%s)" % (
+                step, info['status'],
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(info['time'])))
+                for step, info in steps]))
+
+
+def _diff_options(diff_stat=False):
+    return {
+        'max_lines': int(api.env.diff_max_lines),
+        'max_files': int(api.env.diff_max_files),
+        'stat': diff_stat,
+    }
+
+
+def _prefetch_package(args):
+    """List the tags of a package and diff against the newest one.
+
+    Diffs longer than `diff_prefetch_lines` aren't kept, they get streamed
+    when the operator asks for them instead.
+    """
+    package, wc, diff_stat = args
+    wc_path = api.env.package_info[package]['path']
+    current_tags = _list_sorted_tags(wc, wc_path)
+    default_diff = None
+    if current_tags:
+        tagid = wc.make_tagid(wc_path, current_tags[-1])
+        limit = int(api.env.diff_prefetch_lines)
+        default_diff = []
+        diff = wc.iter_diff_tag(wc_path, tagid, **_diff_options(diff_stat))
+        try:
+            for line in diff:
+                if len(default_diff) >= limit:
+                    default_diff = None
+                    break
+                default_diff.append(line)
+        finally:
+            diff.close()
+    return current_tags, default_diff
+
+
+def _prefetch_packages(package_wcs, diff_stat=False):
+    """Get the tags and default diffs for all the packages at once so the
+    operator doesn't wait on the SCM between prompts
+    """
+    print colors.blue("\nFetching tags and diffs for %s packages" %
+                      len(package_wcs))
+    results = _run_pool(
+        _prefetch_package,
+        [(package, wc, diff_stat) for package, wc in package_wcs],
+        api.env.scm_threads)
+    return dict(zip([package for package, wc in package_wcs], results))
 
 
 def choose_packages(show_diff='yes', save_choices='no'):
-    """Choose the packages that need to be released"""
+    """Choose the packages that need to be released
+
+    Use show_diff=stat to only see a summary of the changed files.
+    """
     save_choices = save_choices.lower() in TRUISMS
     if _load_previous_state(save_choices):
         return
 
+    show_diff = show_diff.lower()
+    diff_stat = show_diff == 'stat'
+    show_diff = diff_stat or show_diff in TRUISMS
     list_package_candidates()
-    for package in api.env.packages:
+    package_wcs = [
+        (package, api.env.scm_factory.get_scm_from_sandbox(
+            api.env.package_info[package]['path']))
+        for package in api.env.packages]
+    prefetched = {}
+    if show_diff:
+        prefetched = _prefetch_packages(package_wcs, diff_stat)
+    for package, wc in package_wcs:
         package_info = api.env.package_info[package]
         wc_path = package_info['path']
-        wc = api.env.scm_factory.get_scm_from_sandbox(wc_path)
 
-        if show_diff.lower() in TRUISMS:
-            current_tags, current_tags_string = _get_tags(wc_path)
+        if show_diff:
+            current_tags, default_diff = prefetched[package]
+            current_tags_string = _format_tags(current_tags)
             cmp_tag = None
             while True:
                 help_txt = DIFF_HELP_TEXT % locals()
@@ -158,7 +403,13 @@ def choose_packages(show_diff='yes', save_choices='no'):
                 if cmp_tag.lower() in PASS_ME or cmp_tag in current_tags:
                     break
             if cmp_tag.lower() not in PASS_ME:
-                print wc.diff_tag(wc_path, tagid)
+                if cmp_tag == default_tag and default_diff is not None:
+                    print "\n".join(default_diff)
+                else:
+                    diff = wc.iter_diff_tag(wc_path, tagid,
+                                            **_diff_options(diff_stat))
+                    for line in diff:
+                        print line
         while True:
             release_package = api.prompt(
                 "Does '%s' need a release?" % package, default="no").lower()
@@ -170,8 +421,7 @@ def choose_packages(show_diff='yes', save_choices='no'):
                 break
 
     if save_choices:
-        with open('.saved_choices', 'w') as f:
-            pickle.dump(api.env.package_info, f)
+        _record_choices()
 
 
 def _next_minor_version(version_string):
@@ -181,13 +431,140 @@ def _next_minor_version(version_string):
     return '.'.join(parts)
 
 
-def release_packages(verbose="no", dev="no", save_choices='no'):
+def _read_install_requires(package_path):
+    """Run egg_info for a package and return the safe names of the projects
+    in its install_requires
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        proc = subprocess.Popen(
+            [sys.executable, 'setup.py', '-q', 'egg_info',
+             '--egg-base', tmp_dir],
+            cwd=package_path, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Couldn't read the requirements of %s:\n%s" % (
+                    package_path, output))
+        requires = []
+        for requires_txt in glob.glob(
+          os.path.join(tmp_dir, '*.egg-info', 'requires.txt')):
+            with open(requires_txt) as f:
+                for section, lines in pkg_resources.split_sections(f):
+                    # only the install_requires, not the extras
+                    if section is not None:
+                        continue
+                    requires.extend([
+                        pkg_resources.safe_name(req.project_name)
+                        for req in pkg_resources.parse_requirements(lines)])
+        return requires
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _release_dependencies(packages):
+    """Map each package to the packages in the same release that it
+    requires. The requirements are cached in the package cache.
+    """
+    cache = {}
+    if api.env.package_cache:
+        cache = _load_cache(api.env.package_cache)
+    paths = [api.env.package_info[package]['path'] for package in packages]
+    signatures = dict([(path, _package_signature(path)) for path in paths])
+    to_read = [
+        path for path in paths
+        if cache.get(path, {}).get('signature') != signatures[path] or
+        'requires' not in cache[path]]
+    try:
+        read = _run_pool(_read_install_requires, to_read,
+                         api.env.release_workers)
+    except RuntimeError as e:
+        api.abort(str(e))
+    requires = {}
+    for path, path_requires in zip(to_read, read):
+        requires[path] = path_requires
+        # only add to entries that are current, see _discover_packages
+        if cache.get(path, {}).get('signature') == signatures[path]:
+            cache[path]['requires'] = path_requires
+    if api.env.package_cache and to_read:
+        _save_cache(api.env.package_cache, cache)
+    names = dict([(package.lower(), package) for package in packages])
+    dependencies = {}
+    for package, path in zip(packages, paths):
+        path_requires = requires.get(path, cache.get(path, {}).get('requires'))
+        dependencies[package] = set([
+            names[name.lower()] for name in path_requires
+            if name.lower() in names])
+    return dependencies
+
+
+def _mkrelease(package):
+    """Run mkrelease for a package and return the captured output.
+
+    Needs warn_only to be set by the caller, this may run in a thread.
+    """
+    package_info = api.env.package_info[package]
+    package_path = package_info['path']
+    package_target = package_info.get(
+        'target',
+        api.env.default_release_target)
+    cmd = "mkrelease %s -d %s %s"
+    # TODO: handle dev release
+    # TODO: alternate release targets (e.g. private)
+    return api.local(
+        cmd % ("-Cp", package_target, package_path),
+        capture=True)
+
+
+def _record_release(package):
+    """Note that the current version of a package has been released
+    """
+    package_info = api.env.package_info[package]
+    _invalidate_tag_index(package_info['path'])
+    # mkrelease tagged and uploaded the package
+    _record_effect('release', package=package, path=package_info['path'],
+                   version=package_info['version'],
+                   target=package_info.get('target',
+                                           api.env.default_release_target))
+
+    current_version = package_info['version']
+    api.env.package_info[package]['version'] = current_version
+    api.env.package_info[package]['next_version'] = _next_minor_version(
+        current_version)
+    api.env.package_info[package]['released_version'] = current_version
+
+
+def _record_failed_release(package):
+    """mkrelease tags before it uploads, so a release that failed may have
+    left a tag behind that rollback_release has to delete
+    """
+    package_info = api.env.package_info[package]
+    path = package_info['path']
+    _invalidate_tag_index(path)
+    wc = api.env.scm_factory.get_scm_from_sandbox(path)
+    if package_info['version'] in wc.list_tags(path):
+        _record_effect('tag', package=package, path=path,
+                       version=package_info['version'])
+
+
+def release_packages(verbose="no", dev="no", save_choices='no',
+                     workers=None):
+    """Release the chosen packages with mkrelease
+
+    With more than one worker, packages are released at the same time,
+    except that a package is only released after the packages it requires.
+    """
     save_choices = save_choices.lower() in TRUISMS
+    if workers is None:
+        workers = api.env.release_workers
+    workers = int(workers)
     if not api.env.to_release:
         print colors.yellow("\nNo packages to release.")
         return
     print colors.blue("\nReleasing packages")
     print "\n".join(api.env.to_release) + "\n"
+    to_release = []
     for package in api.env.to_release:
         package_info = api.env.package_info[package]
         # first check to see if this version of the package was already
@@ -199,33 +576,104 @@ def release_packages(verbose="no", dev="no", save_choices='no'):
             print colors.red(msg % (package, current_version))
             # since it was already release, just move on to the next package
             continue
-        package_path = package_info['path']
-        package_target = package_info.get(
-            'target',
-            api.env.default_release_target)
-        cmd = "mkrelease %s -d %s %s"
-        # TODO: handle dev release
-        # TODO: alternate release targets (e.g. private)
-        with api.settings(warn_only=True):
-            output = api.local(
-                cmd % ("-Cp", package_target, package_path),
-                capture=True)
+        to_release.append(package)
+
+    def released(package, output):
         if output.failed:
             print output
+            _record_failed_release(package)
+            if save_choices:
+                _record_state(api.env.deploy_state, package, 'released',
+                              'failed')
             api.abort(output.stderr)
-
-        api.env.package_info[package]['version'] = current_version
-        api.env.package_info[package]['next_version'] = _next_minor_version(
-            current_version)
-        api.env.package_info[package]['released_version'] = current_version
+        _record_release(package)
         if save_choices:
-            with open('.saved_choices', 'w') as f:
-                pickle.dump(api.env.package_info, f)
+            package_info = api.env.package_info[package]
+            _record_state(api.env.deploy_state, package, 'released',
+                          version=package_info['version'],
+                          next_version=package_info['next_version'],
+                          released_version=package_info['released_version'])
         if verbose.lower() in TRUISMS:
             print output
 
+    with api.settings(warn_only=True):
+        if workers > 1 and len(to_release) > 1:
+            dependencies = _release_dependencies(to_release)
+            _run_graph(to_release, dependencies, _mkrelease, workers,
+                       released)
+        else:
+            for package in to_release:
+                released(package, _mkrelease(package))
+
+
+def _commit_batch(batch):
+    wc, root, paths, message = batch
+    rc, lines = wc.commit_paths(root, paths, message, True)
+    return root, paths, message, rc, lines
+
+
+def _commit_changes(changes, action='Prepare', record=True):
+    """Commit the (sandbox, files, name, version) changes.
+
+    With scm_batch_commits the files in the same working copy go into one
+    commit that names every package and version, and the working copies
+    are committed at the same time. Otherwise each sandbox is committed on
+    its own.
+    """
+    if not api.env.scm_batch_commits:
+        for sandbox, files, name, version in changes:
+            wc = api.env.scm_factory.get_scm_from_sandbox(sandbox)
+            wc.commit_sandbox(sandbox, name, version, True)
+            if record:
+                _record_effect('commit', files=[
+                    os.path.abspath(path) for path in files])
+        return
+    batches = {}
+    order = []
+    for sandbox, files, name, version in changes:
+        wc = api.env.scm_factory.get_scm_from_sandbox(sandbox)
+        root = wc.get_sandbox_root(sandbox)
+        key = (wc.__class__.__name__, root)
+        if key not in batches:
+            batches[key] = (wc, root, [], [])
+            order.append(key)
+        wc, root, paths, names = batches[key]
+        for path in files:
+            path = os.path.relpath(os.path.abspath(path), root)
+            if path not in paths:
+                paths.append(path)
+        names.append('%s %s' % (name, version))
+    jobs = []
+    for key in order:
+        wc, root, paths, names = batches[key]
+        jobs.append((wc, root, paths, '%s %s.' % (action, ', '.join(names))))
+    failed = []
+    for root, paths, message, rc, lines in _run_pool(_commit_batch, jobs,
+                                                     api.env.scm_threads):
+        print "%s: %s" % (root, message)
+        if rc != 0:
+            print colors.red("\n".join(lines))
+            failed.append(root)
+        elif record:
+            _record_effect('commit', files=[
+                os.path.join(root, path) for path in paths])
+    if failed:
+        api.abort("Committing failed in %s" % ", ".join(failed))
+
+
+def _commit_pending():
+    changes = _pending_commits[:]
+    del _pending_commits[:]
+    if changes:
+        _commit_changes(changes)
+
 
-def bump_package_versions():
+def bump_package_versions(commit='yes'):
+    """Bump the packages to their next version
+
+    With commit=no the changes are committed together with the next
+    update_versions_cfg.
+    """
     if not api.env.to_release:
         return
     print colors.blue("Bumping package versions")
@@ -235,28 +683,39 @@ def bump_package_versions():
         if api.env.package_info[package].get('release', False)]
     print "\n".join(bumpers)
     for package in api.env.to_release:
-        package_info = api.env.package_info[package]
-        wc = api.env.scm_factory.get_scm_from_sandbox(package_info['path'])
-        next_version = package_info['next_version']
-        version_location = package_info.get(
-            'version_location',
-            api.env.default_version_location)
-        version_file = "%s/%s" % (package_info['path'], version_location[0])
-        version_re = version_location[1]
-        if os.path.exists(version_file):
-            with open(version_file, 'r') as f:
-                vf_contents = f.read()
-            with open(version_file, 'w') as f:
-                vf_new = re.sub(
-                    version_re,
-                    '\g<1>' + next_version + '\g<3>',
-                    vf_contents,
-                    re.M)
-                f.write(vf_new)
-            wc.commit_sandbox(package_info['path'],
-                              package,
-                              next_version,
-                              True)
+        change = _bump_package_version(package)
+        if change is not None:
+            _pending_commits.append(change)
+    if commit.lower() in TRUISMS:
+        _commit_pending()
+
+
+def _bump_package_version(package):
+    """Write the next version of a package into its version file. Returns
+    the change to commit, or None if there is no version file.
+    """
+    package_info = api.env.package_info[package]
+    next_version = package_info['next_version']
+    version_location = package_info.get(
+        'version_location',
+        api.env.default_version_location)
+    version_file = "%s/%s" % (package_info['path'], version_location[0])
+    version_re = version_location[1]
+    if not os.path.exists(version_file):
+        return None
+    _record_effect('edit_version', package=package,
+                   file=os.path.abspath(version_file), version_re=version_re,
+                   old=package_info['version'], new=next_version)
+    with open(version_file, 'r') as f:
+        vf_contents = f.read()
+    with open(version_file, 'w') as f:
+        vf_new = re.sub(
+            version_re,
+            '\g<1>' + next_version + '\g<3>',
+            vf_contents,
+            re.M)
+        f.write(vf_new)
+    return (package_info['path'], [version_file], package, next_version)
 
 def _get_buildout_version():
     with open('version.txt') as f:
@@ -267,43 +726,35 @@ def update_versions_cfg():
     """
     if not api.env.to_release:
         return
+    # commits the version bumps that are waiting too, if there are any
+    _pending_commits.append(_update_versions_file())
+    _commit_pending()
+
+
+def _update_versions_file():
+    """Pin the released versions in versions.cfg and return the change to
+    commit
+    """
     print colors.blue("Updating versions.cfg")
     # get the version file contents
     v_cfg = api.env.versions_cfg_location
-    with open(v_cfg) as f:
-        vcfg_content = f.read()
-    missing_versions = []
-    # loop through the packages and update the versions
-    with open(v_cfg, 'w') as f:
-        for package in api.env.to_release:
-            package_info = api.env.package_info[package]
-            package_version = package_info['version']
-            package_re = "%s.*" % package
-            version_pins = re.findall(package_re, vcfg_content)
-            if not version_pins:
-                print colors.red(
-                    '%s was not in versions.cfg. It was added.' % package)
-                missing_versions.append('%s = %s' % (package, package_version))
-            else:
-                if len(version_pins) > 1:
-                    print colors.red(
-                        "WARNING: There were multiple pins for %s" % package)
-                vcfg_content = re.sub(
-                    package_re,
-                    "%s = %s" % (package, package_version),
-                    vcfg_content,
-                    re.M)
-        f.write(vcfg_content)
-    # add any missing version definitions to the config file
-    if missing_versions:
-        with open(v_cfg, 'a') as f:
-            for missing in missing_versions:
-                f.write("%s\n" % missing)
+    lines, index = _read_versions(v_cfg)
+    pins = [(package, api.env.package_info[package]['version'])
+            for package in api.env.to_release]
+    _record_effect('edit_pins', file=os.path.abspath(v_cfg),
+                   old=_get_pins(lines, index, api.env.to_release),
+                   new=dict(pins))
+    # all the pins are updated in one pass over the file
+    multiple, added = _update_pins(lines, index, pins)
+    for package in multiple:
+        print colors.red("WARNING: There were multiple pins for %s" % package)
+    for package in added:
+        print colors.red('%s was not in versions.cfg. It was added.' % package)
+    _write_versions(v_cfg, lines)
     cwd = os.getcwd()
-    wc = api.env.scm_factory.get_scm_from_sandbox(cwd)
     name = os.path.basename(cwd)
     buildout_ver = _get_buildout_version()
-    wc.commit_sandbox(cwd, name, buildout_ver, True)
+    return (cwd, [v_cfg], name, buildout_ver)
 
 
 
@@ -317,54 +768,334 @@ def _get_buildout_url():
     return sandbox_url, base_dir
 
 
-def tag_buildout():
-    if not api.env.to_release:
+def tag_buildout(confirm='yes'):
+    if not api.env.to_release and confirm.lower() in TRUISMS:
         do_release = contrib.console.confirm(\
                         "No packages selected; release only buildout?",
                         default=False)
         if not do_release:
             api.abort("You didn't want to release")
     print colors.blue("Tagging buildout")
+    version = _create_buildout_tag()
+    _commit_changes([_bump_buildout_version(version)])
+
+
+def _create_buildout_tag():
+    """Tag the buildout with the version in version.txt and deploy that
+    tag. Returns the version.
+    """
     cwd = os.getcwd()
     wc = api.env.scm_factory.get_scm_from_sandbox(cwd)
     version = _get_buildout_version()
     tagid = wc.make_tagid(cwd, version)
     name = os.path.basename(cwd)
     wc.create_tag(cwd, tagid, name, version, True)
-    # now bump the version and commit
+    _record_effect('tag', path=cwd, version=version)
+    _invalidate_tag_index(cwd)
+    api.env.deploy_tag = version
+    return version
+
+
+def _bump_buildout_version(version):
+    """Write the version after the tagged one to version.txt and return
+    the change to commit
+    """
+    cwd = os.getcwd()
+    new_version = _next_minor_version(version)
+    _record_effect('edit_buildout_version',
+                   file=os.path.abspath('version.txt'), old=version,
+                   new=new_version)
     with open('version.txt', 'w') as f:
-        new_version = _next_minor_version(version)
         f.write(new_version)
-    api.env.deploy_tag = version
-    wc.commit_sandbox(cwd, name, new_version, True)
+    return (cwd, ['version.txt'], os.path.basename(cwd), new_version)
+
 
+def _rollout_batches(hosts, rollout, batch_size):
+    """Split the hosts up into the batches they are released in
+    """
+    if rollout not in ROLLOUTS:
+        api.abort("Unknown rollout %s, use one of: %s" % (
+            rollout, ", ".join(ROLLOUTS)))
+    if rollout == 'serial':
+        return [[host] for host in hosts]
+    batches = []
+    if rollout == 'canary' and hosts:
+        batches.append(hosts[:1])
+        hosts = hosts[1:]
+    if rollout == 'all' or not batch_size:
+        batch_size = len(hosts)
+    for i in range(0, len(hosts), batch_size):
+        batches.append(hosts[i:i + batch_size])
+    return batches
+
+
+def _timed_release_to_env():
+    """Release to the current host, returns how long it took and how long
+    each instance took to warm up
+    """
+    start = time.time()
+    warm = _release_to_env()
+    return time.time() - start, warm
+
+
+def _supervisor_summary(output):
+    """Count the processes in each state in the supervisorctl status
+    output. Returns the summary and the lines supervisor complained about
+    or of processes that failed.
+    """
+    states = {}
+    errors = []
+    for line in output.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) < 2 or not parts[1].isupper() or 'ERROR' in line:
+            errors.append(line.strip())
+            continue
+        states[parts[1]] = states.get(parts[1], 0) + 1
+        if parts[1] in SUPERVISOR_FAILED_STATES:
+            errors.append(line.strip())
+    summary = ", ".join(["%s %s" % (count, state)
+                         for state, count in sorted(states.items())])
+    return summary or "-", errors
+
+
+def _probe_host(buildout_dir, base_url, supervisor_processes):
+    """Check that the current host can be released to, in one round-trip.
+    Returns what was found and the problems that would stop the release.
+    """
+    probe = {'buildout': 'missing', 'tag': '-', 'free': '-',
+             'supervisor': '-', 'problems': []}
+    commands = [
+        "test -d %s" % buildout_dir,
+        "cd %s && svn info" % buildout_dir,
+        "df -Pk %s" % buildout_dir,
+        "supervisorctl status %s" % supervisor_processes,
+    ]
+    if api.env.deploy_mode == 'slots':
+        commands.append("readlink %s" % buildout_dir)
+    try:
+        results = _remote_batch(commands)
+    except (Exception, SystemExit):
+        # fabric has already said what went wrong
+        probe['problems'].append("couldn't run the checks")
+        return probe
+    problems = probe['problems']
+    if results[0][0] != 0:
+        problems.append("no buildout at %s" % buildout_dir)
+        return probe
+    probe['buildout'] = 'ok'
+    url = None
+    for line in results[1][1].splitlines():
+        if line.startswith('URL:'):
+            url = line.split(':', 1)[1].strip()
+    if results[1][0] != 0 or url is None:
+        problems.append("not an svn working copy")
+    elif url != base_url and not url.startswith(base_url + '/'):
+        problems.append("checked out from %s" % url)
+    elif '/tags/' in url:
+        probe['tag'] = url.split('/tags/', 1)[1].strip('/')
+    else:
+        probe['tag'] = url[len(base_url):].strip('/') or '/'
+    lines = results[2][1].splitlines()
+    if results[2][0] == 0 and len(lines) > 1:
+        free_mb = int(lines[-1].split()[3]) / 1024
+        probe['free'] = "%sM" % free_mb
+        if free_mb < int(api.env.preflight_min_free_mb):
+            problems.append("only %sM free" % free_mb)
+    else:
+        problems.append("couldn't find the free disk space")
+    probe['supervisor'], errors = _supervisor_summary(results[3][1])
+    problems.extend(["supervisor: %s" % error for error in errors])
+    if api.env.deploy_mode == 'slots' and results[4][0] != 0:
+        problems.append("%s isn't a release slot symlink, run "
+                        "setup_release_slots first" % buildout_dir)
+    return probe
 
-def release_to(target='testing'):
+
+def _preflight_hosts(hosts, concurrency=None):
+    """Check all the hosts at the same time and abort before anything is
+    changed when one of them can't be released to
+    """
+    # settings that are missing are the same for every host, so abort on
+    # them before connecting to any
+    buildout_dir = _get_buildout_dir()
+    trunk_url, base_url = _get_buildout_url()
+    supervisor_processes = _get_supervisor_processes()
+    print colors.blue("Checking %s" % ", ".join(hosts))
+    task = api.parallel(pool_size=concurrency)(_probe_host)
+    with api.settings(api.hide('running', 'status')):
+        probes = api.execute(task, buildout_dir, base_url,
+                             supervisor_processes, hosts=hosts)
+    row = "    %-24s %-8s %-20s %8s  %s"
+    print row % ('host', 'buildout', 'deployed', 'free', 'supervisor')
+    failed = []
+    for host in hosts:
+        probe = probes[host]
+        print row % (host, probe['buildout'], probe['tag'], probe['free'],
+                     probe['supervisor'])
+        if probe['tag'] == api.env.deploy_tag:
+            print colors.yellow("        %s is already deployed" %
+                                api.env.deploy_tag)
+        for problem in probe['problems']:
+            print colors.red("        %s" % problem)
+        if probe['problems']:
+            failed.append(host)
+    if failed:
+        api.abort("Not releasing, the checks failed on %s" %
+                  ", ".join(failed))
+
+
+def preflight(target='testing', concurrency=None):
+    """Check that all the hosts of an environment can be released to
+
+    The buildout, its svn URL and deployed tag, the free disk space and
+    the supervisor processes are checked on every host at the same time.
+    """
+    api.env.deploy_env = target
+    if concurrency is None:
+        concurrency = api.env.rollout_concurrency
+    hosts = api.env.get('%s_hosts' % target,
+                        DEFAULT_HOSTS.get(target, []))
+    _preflight_hosts(hosts, int(concurrency) or None)
+    print colors.blue("All hosts of %s are ready" % target)
+
+
+def release_to(target='testing', rollout=None, batch_size=None,
+               concurrency=None, confirm='yes', check=None):
     """Release to a particular environment: testing, staging, prod
+
+    rollout is one of serial, all, batch or canary. Hosts in a batch are
+    released at the same time, at most `concurrency` at once, and the next
+    batch only starts once the whole batch succeeded. canary releases to
+    the first host on its own before the rest. confirm=no skips the
+    question before releasing to prod. Unless check=no all the hosts are
+    checked with preflight before the first one is touched.
     """
     print colors.blue("Releasing to: %s" % target)
-    if target == 'prod':
+    if target == 'prod' and confirm.lower() in TRUISMS:
         do_release = contrib.console.confirm("Are you sure?", default=False)
         if not do_release:
             api.abort("You didn't want to release")
     api.env.deploy_env = target
+    if rollout is None:
+        rollout = api.env.rollout
+    if batch_size is None:
+        batch_size = api.env.rollout_batch_size
+    if concurrency is None:
+        concurrency = api.env.rollout_concurrency
+    if check is None:
+        check = api.env.rollout_preflight
+    else:
+        check = check.lower() in TRUISMS
+    batch_size = int(batch_size)
+    concurrency = int(concurrency) or None
     hosts = api.env.get('%s_hosts' % target,
                         DEFAULT_HOSTS.get(target, []))
-    for host in hosts:
-        with api.settings(host_string=host):
-            _release_to_env()
+    # choose the tag up front, the hosts can't prompt when run in parallel
+    if not api.env.deploy_tag:
+        _choose_deploy_tag()
+    if check and hosts:
+        _preflight_hosts(hosts, concurrency)
+    timings = []
+    start = time.time()
+    try:
+        for batch in _rollout_batches(hosts, rollout, batch_size):
+            if len(batch) == 1:
+                with api.settings(host_string=batch[0]):
+                    timings.append((batch[0], _timed_release_to_env()))
+                continue
+            print colors.blue("Releasing to %s" % ", ".join(batch))
+            task = api.parallel(pool_size=concurrency)(_timed_release_to_env)
+            results = api.execute(task, hosts=batch)
+            timings.extend([(host, results[host]) for host in batch])
+    finally:
+        if timings:
+            print colors.blue("\nRelease timings:")
+            for host, (seconds, warm) in timings:
+                print "    %-30s %8.1fs" % (host, seconds)
+                for url, warm_seconds in warm:
+                    print "      %-28s %8ss warm-up" % (url, warm_seconds)
+            print "    %-30s %8.1fs" % ("total", time.time() - start)
+
+
+def _sort_tags(tags):
+    return sorted(tags, key=lambda x: pkg_resources.parse_version(x))
+
+
+def _format_tags(current_tags):
+    return "\n    ".join(current_tags) or "No tags created yet"
+
+
+def _get_tag_index():
+    global _tag_index
+    if _tag_index is None:
+        _tag_index = _load_cache(api.env.tag_index)
+    return _tag_index
+
+
+def _list_sorted_tags(wc, wc_path):
+    """List the tags of a working copy in version order.
+
+    The tags are kept in the tag index together with a key describing the
+    state of the repository (svn revision, git tag refs, hg tip), so an
+    unchanged repository doesn't have to be asked again.
+    """
+    if not api.env.tag_index:
+        return _sort_tags(wc.list_tags(wc_path))
+    key = wc.get_tag_index_key(wc_path)
+    with _tag_index_lock:
+        entry = _get_tag_index().get(wc_path)
+    if key is not None and entry is not None and entry['key'] == key:
+        return list(entry['tags'])
+    current_tags = _sort_tags(wc.list_tags(wc_path))
+    if key is not None:
+        with _tag_index_lock:
+            tag_index = _get_tag_index()
+            tag_index[wc_path] = {'key': key, 'tags': current_tags}
+            _save_cache(api.env.tag_index, tag_index)
+    return list(current_tags)
+
+
+def _invalidate_tag_index(wc_path):
+    """Forget the tags of a working copy, e.g. after tagging it
+    """
+    if not api.env.tag_index:
+        return
+    with _tag_index_lock:
+        tag_index = _get_tag_index()
+        if tag_index.pop(wc_path, None) is not None:
+            _save_cache(api.env.tag_index, tag_index)
+
+
+def clear_tag_index():
+    """Remove the local tag index so all tags are listed again
+    """
+    global _tag_index
+    with _tag_index_lock:
+        _tag_index = None
+        if api.env.tag_index and os.path.exists(api.env.tag_index):
+            os.unlink(api.env.tag_index)
 
 
 def _get_tags(wc_path):
     wc = api.env.scm_factory.get_scm_from_sandbox(wc_path)
     with api.lcd(wc_path):
-        current_tags = sorted(wc.list_tags(wc_path),
-                              key=lambda x: pkg_resources.parse_version(x))
-    return (current_tags,
-            "\n    ".join(current_tags) or "No tags created yet")
+        current_tags = _list_sorted_tags(wc, wc_path)
+    return (current_tags, _format_tags(current_tags))
 
 
-def _release_to_env():
+def _choose_deploy_tag():
+    current_tags, current_tags_string = _get_tags(os.getcwd())
+    target = api.env.deploy_env
+    help_txt = TAG_HELP_TEXT % locals()
+    default_tag = ''
+    if len(current_tags) > 0:
+        default_tag = current_tags[-1]
+    api.env.deploy_tag = api.prompt(help_txt, default=default_tag)
+
+
+def _get_buildout_dir():
     base_env_path = "base_%s_path" % api.env.deploy_env
     base_path = api.env.get(base_env_path,
                             DEFAULT_PATHS.get(api.env.deploy_env))
@@ -374,17 +1105,271 @@ def _release_to_env():
                                 api.env.project_name)
     if not buildout_name:
         api.abort("Buildout name not defined for %s" % api.env.deploy_env)
+    return "%s/%s" % (base_path, buildout_name)
+
+
+def _get_supervisor_processes():
+    supervisor_processes = api.env.get(
+        "%s_supervisor_processes" % api.env.deploy_env,
+        "")
+    if not supervisor_processes:
+        api.abort("Couldn't find supervisor process names")
+    return supervisor_processes
+
+
+def _get_slot_dirs(buildout_dir):
+    """The directories holding the release slots and the data they share
+    """
+    return "%s-releases" % buildout_dir, "%s-shared" % buildout_dir
+
+
+def _list_slots(releases_dir):
+    """The release slots on the current host, oldest first
+    """
+    with api.settings(api.hide('running', 'stdout'), warn_only=True):
+        result = api.run("ls -1 %s" % releases_dir)
+    if result.failed:
+        return []
+    # slots are named <tag>-<timestamp>
+    names = sorted(result.split(), key=lambda x: x.rsplit('-', 1)[-1])
+    return ["%s/%s" % (releases_dir, name) for name in names]
+
+
+def _current_slot(buildout_dir):
+    with api.settings(api.hide('running', 'stdout'), warn_only=True):
+        result = api.run("readlink %s" % buildout_dir)
+    if result.failed or not result.strip():
+        api.abort("%s isn't a release slot symlink, run setup_release_slots "
+                  "first" % buildout_dir)
+    return result.strip()
+
+
+def _prune_slots(releases_dir, keep_slots):
+    """Remove the oldest slots, keeping `keep_slots` and the current one
+    """
+    keep = int(api.env.release_slots_keep)
+    if keep <= 0:
+        return
+    slots = [slot for slot in _list_slots(releases_dir)
+             if slot not in keep_slots]
+    for slot in slots[:max(0, len(slots) - max(0, keep - len(keep_slots)))]:
+        api.sudo("rm -rf %s" % slot, user='zope')
+
+
+def _remote_svn(cmd, buildout_dir):
+    with api.settings(api.hide('running', 'stdout', 'warnings'),
+                      warn_only=True):
+        with api.cd(buildout_dir):
+            return api.sudo("svn %s" % cmd, user='zope')
+
+
+def _changed_pins(diff):
+    """The pins added or changed in a unified diff of a versions file, or
+    None if a pin was removed
+    """
+    added = {}
+    removed = set()
+    for line in diff.splitlines():
+        if line.startswith('+++') or line.startswith('---'):
+            continue
+        match = PIN_RE.match(line[1:])
+        if match is None:
+            continue
+        if line.startswith('+'):
+            added[match.group(1).lower()] = (match.group(1), match.group(2))
+        elif line.startswith('-'):
+            removed.add(match.group(1).lower())
+    if removed - set(added):
+        return None
+    return added.values()
+
+
+def _inert_path(path):
+    """Whether buildout_inert_files says buildout doesn't use the path.
+    Patterns with a / match the whole path, others the file name.
+    """
+    for pattern in api.env.buildout_inert_files:
+        if '/' not in pattern:
+            if fnmatch.fnmatch(os.path.basename(path), pattern):
+                return True
+        elif fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+
+def _buildout_action(buildout_dir, tag_url):
+    """Decide how buildout needs to run to go from the deployed tag to
+    `tag_url`. Returns the action (full, offline or skip) and the reason.
+    """
+    if not api.env.buildout_change_detection:
+        return 'full', "change detection is off"
+    result = _remote_svn("info", buildout_dir)
+    current_url = None
+    for line in result.splitlines():
+        if line.startswith('URL:'):
+            current_url = line.split(':', 1)[1].strip()
+    if result.failed or current_url is None:
+        return 'full', "couldn't find the deployed URL"
+    if current_url == tag_url:
+        if '/tags/' in tag_url:
+            return 'skip', "the tag is already deployed"
+        return 'full', "%s isn't a tag" % tag_url
+    result = _remote_svn('diff --summarize "%s" "%s"' % (current_url,
+                                                          tag_url),
+                         buildout_dir)
+    if result.failed:
+        return 'full', "couldn't compare %s to %s" % (current_url, tag_url)
+    changed = []
+    for line in result.splitlines():
+        url = line[8:].strip()
+        if url.startswith(current_url + '/'):
+            changed.append(url[len(current_url) + 1:])
+    # buildout reads more than its configuration, e.g. the templates of
+    # collective.recipe.template, so only files known not to matter are
+    # left out
+    relevant = [path for path in changed if not _inert_path(path)]
+    if not relevant:
+        return 'skip', "only files buildout doesn't use changed"
+    versions_files = api.env.buildout_versions_files
+    other = [path for path in relevant
+             if os.path.basename(path) not in versions_files]
+    if other:
+        return 'full', "changed: %s" % ", ".join(other)
+    pins = []
+    for path in relevant:
+        diff = _remote_svn('diff "%s/%s" "%s/%s"' % (
+            current_url, path, tag_url, path), buildout_dir)
+        path_pins = None
+        if diff.succeeded:
+            path_pins = _changed_pins(diff)
+        if path_pins is None:
+            return 'full', "pins were removed from %s" % path
+        pins.extend(path_pins)
+    if not pins:
+        return 'skip', "only comments changed in %s" % ", ".join(relevant)
+    # the eggs for the new pins have to be there for an offline run
+    missing = []
+    for name, version in pins:
+        patterns = [
+            "%s/%s-%s-*" % (eggs_dir, pkg_resources.to_filename(name),
+                            pkg_resources.to_filename(version))
+            for eggs_dir in api.env.buildout_eggs_dirs]
+        with api.settings(api.hide('running', 'stdout', 'warnings'),
+                          warn_only=True):
+            with api.cd(buildout_dir):
+                found = api.run("ls -d %s" % " ".join(patterns))
+        if found.failed or not found.strip():
+            missing.append("%s %s" % (name, version))
+    if missing:
+        return 'full', "eggs not installed yet: %s" % ", ".join(missing)
+    return 'offline', "only pins changed and the eggs are installed"
+
+
+def _run_buildout(action, reason):
+    print colors.blue("Buildout: %s (%s)" % (action, reason))
+    if action == 'full':
+        api.sudo("bin/buildout -v", user='zope')
+    elif action == 'offline':
+        api.sudo("bin/buildout -v -N -o", user='zope')
+
+
+def _release_to_slot(buildout_dir, tag_url, supervisor_processes):
+    """Build the tag in a new release slot while the site is up, then
+    only restart to switch the buildout symlink over to it
+    """
+    releases_dir, shared_dir = _get_slot_dirs(buildout_dir)
+    current_slot = _current_slot(buildout_dir)
+    new_slot = "%s/%s-%s" % (releases_dir, api.env.deploy_tag,
+                             time.strftime('%Y%m%d%H%M%S'))
+    # start from a copy of the current slot so buildout only has to update
+    api.sudo("rsync -a --exclude /var %s/ %s/" % (current_slot, new_slot),
+             user='zope')
+    api.sudo("ln -s %s/var %s/var" % (shared_dir, new_slot), user='zope')
+    action, reason = _buildout_action(new_slot, tag_url)
+    if action == 'skip':
+        # the scripts, egg-links and configs copied from the current slot
+        # still point into it, buildout has to write them for this slot
+        action, reason = 'offline', "%s, but this is a new slot" % reason
+    with api.cd(new_slot):
+        api.sudo("svn switch %s" % tag_url, user='zope')
+        api.sudo("svn up", user='zope')
+        _run_buildout(action, reason)
+    # the site is only down for the restart
+    api.run("supervisorctl stop %s" % supervisor_processes)
+    api.sudo("ln -sfn %s %s" % (new_slot, buildout_dir), user='zope')
+    api.run("supervisorctl start %s" % supervisor_processes)
+    warm = _warm_up()
+    _prune_slots(releases_dir, [current_slot, new_slot])
+    return warm
+
+
+def setup_release_slots(target='testing'):
+    """Move the buildouts of an environment into release slots.
+
+    The buildout directory becomes a symlink to the slot and var/ is moved
+    to a directory that all the slots share.
+    """
+    api.env.deploy_env = target
+    hosts = api.env.get('%s_hosts' % target,
+                        DEFAULT_HOSTS.get(target, []))
+    for host in hosts:
+        with api.settings(host_string=host):
+            buildout_dir = _get_buildout_dir()
+            supervisor_processes = _get_supervisor_processes()
+            releases_dir, shared_dir = _get_slot_dirs(buildout_dir)
+            if contrib.files.exists(releases_dir):
+                print colors.yellow(
+                    "%s: %s already uses release slots" % (host, buildout_dir))
+                continue
+            slot = "%s/initial-%s" % (releases_dir,
+                                      time.strftime('%Y%m%d%H%M%S'))
+            api.run("supervisorctl stop %s" % supervisor_processes)
+            api.sudo("mkdir -p %s %s" % (releases_dir, shared_dir),
+                     user='zope')
+            api.sudo("mv %s/var %s/var" % (buildout_dir, shared_dir),
+                     user='zope')
+            api.sudo("mv %s %s" % (buildout_dir, slot), user='zope')
+            api.sudo("ln -s %s/var %s/var" % (shared_dir, slot), user='zope')
+            # the old paths still work through the symlink, so there is no
+            # need to run buildout
+            api.sudo("ln -s %s %s" % (slot, buildout_dir), user='zope')
+            api.run("supervisorctl start %s" % supervisor_processes)
+
+
+def rollback_slot(target='testing', slot=None):
+    """Switch an environment back to the previous release slot
+    """
+    api.env.deploy_env = target
+    hosts = api.env.get('%s_hosts' % target,
+                        DEFAULT_HOSTS.get(target, []))
+    for host in hosts:
+        with api.settings(host_string=host):
+            buildout_dir = _get_buildout_dir()
+            supervisor_processes = _get_supervisor_processes()
+            releases_dir, shared_dir = _get_slot_dirs(buildout_dir)
+            current_slot = _current_slot(buildout_dir)
+            if slot is not None:
+                previous_slot = "%s/%s" % (releases_dir, slot)
+            else:
+                slots = _list_slots(releases_dir)
+                if current_slot not in slots or \
+                  slots.index(current_slot) == 0:
+                    api.abort("%s: no slot to roll back to" % host)
+                previous_slot = slots[slots.index(current_slot) - 1]
+            print colors.blue("%s: switching to %s" % (host, previous_slot))
+            api.run("supervisorctl stop %s" % supervisor_processes)
+            api.sudo("ln -sfn %s %s" % (previous_slot, buildout_dir),
+                     user='zope')
+            api.run("supervisorctl start %s" % supervisor_processes)
+
+
+def _release_to_env():
     # check for the buildout
-    buildout_dir = "%s/%s" % (base_path, buildout_name)
+    buildout_dir = _get_buildout_dir()
     trunk_url, base_url = _get_buildout_url()
 
     if not api.env.deploy_tag:
-        current_tags, current_tags_string = _get_tags(os.getcwd())
-        target = api.env.deploy_env
-        help_txt = TAG_HELP_TEXT % locals()
-        if len(current_tags) > 0:
-            default_tag = current_tags[-1]
-        api.env.deploy_tag = api.prompt(help_txt, default=default_tag)
+        _choose_deploy_tag()
 
     tag_url = "%s/tags/%s" % (base_url, api.env.deploy_tag)
     if not contrib.files.exists(buildout_dir):
@@ -400,21 +1385,22 @@ def _release_to_env():
         #    api.run("python%s bootstrap.py %s" % (
         #        api.env.python_version,
         #        api.env.bootstrap_args))
-    supervisor_processes = api.env.get(
-        "%s_supervisor_processes" % api.env.deploy_env,
-        "")
-    if not supervisor_processes:
-        api.abort("Couldn't find supervisor process names")
+    supervisor_processes = _get_supervisor_processes()
+    if api.env.deploy_mode == 'slots':
+        return _release_to_slot(buildout_dir, tag_url, supervisor_processes)
+    # check for changes in the buildout before switching
+    action, reason = _buildout_action(buildout_dir, tag_url)
     # stop instance
     api.run("supervisorctl stop %s" % supervisor_processes)
     # TODO: get the data from prod/staging here
     with api.cd(buildout_dir):
-        # TODO: Check for changes in the buildout
         # switch to the new tag
         api.sudo("svn switch %s" % tag_url, user='zope')
         api.sudo("svn up", user='zope')
         # TODO: check for issues with switch
         # run buildout
-        api.sudo("bin/buildout -v", user='zope')
+        _run_buildout(action, reason)
     # start instance
     api.run("supervisorctl start %s" % supervisor_processes)
+    # don't leave the instances cold for the first visitors
+    return _warm_up()
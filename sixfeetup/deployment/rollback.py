@@ -0,0 +1,158 @@
+import os
+import re
+import time
+
+from fabric import api
+from fabric import colors
+
+from jarn.mkrelease.scm import SCMFactory
+
+from sixfeetup.deployment import release
+from sixfeetup.deployment.journal import _append_journal
+from sixfeetup.deployment.journal import _read_journal
+from sixfeetup.deployment.parallel import _run_pool
+from sixfeetup.deployment.utils import TRUISMS
+from sixfeetup.deployment.versions import _read_versions
+from sixfeetup.deployment.versions import _remove_pins
+from sixfeetup.deployment.versions import _update_pins
+from sixfeetup.deployment.versions import _write_versions
+
+TAG_EFFECTS = ['release', 'tag']
+EDIT_EFFECTS = ['edit_version', 'edit_pins', 'edit_buildout_version']
+
+
+def _remaining_effects(entries, run):
+    """The side effects of a run that haven't been undone yet
+    """
+    run_entries = [entry for entry in entries if entry.get('run') == run]
+    undone = set([entry['effect'] for entry in run_entries
+                  if entry['action'] == 'undo'])
+    return [entry for entry in run_entries
+            if entry['action'] != 'undo' and entry['id'] not in undone]
+
+
+def _mark_undone(run, effect):
+    _append_journal(api.env.release_journal, {
+        'run': run, 'action': 'undo', 'effect': effect['id'],
+        'time': time.time()})
+
+
+def _delete_tag(effect):
+    """Delete the tag made by mkrelease or tag_buildout, this runs in a
+    thread
+    """
+    path = effect['path']
+    wc = api.env.scm_factory.get_scm_from_sandbox(path)
+    tagid = wc.make_tagid(path, effect['version'])
+    rc, lines = wc.delete_tag(path, tagid)
+    return effect, tagid, rc, lines
+
+
+def _revert_edit(effect):
+    """Put a file edited by the release back the way it was
+    """
+    path = effect['file']
+    if effect['action'] == 'edit_version':
+        with open(path) as f:
+            contents = f.read()
+        contents = re.sub(effect['version_re'],
+                          '\g<1>' + effect['old'] + '\g<3>',
+                          contents,
+                          re.M)
+        with open(path, 'w') as f:
+            f.write(contents)
+    elif effect['action'] == 'edit_pins':
+        lines, index = _read_versions(path)
+        old = effect['old']
+        _update_pins(lines, index, [(name, version)
+                                    for name, version in sorted(old.items())
+                                    if version is not None])
+        _remove_pins(lines, index, [name for name, version in old.items()
+                                    if version is None])
+        _write_versions(path, lines)
+    else:
+        with open(path, 'w') as f:
+            f.write(effect['old'])
+
+
+def _describe_edit(effect):
+    if effect['action'] == 'edit_pins':
+        return '%s: %s' % (effect['file'], ', '.join([
+            '%s %s' % (name, version or '(remove)')
+            for name, version in sorted(effect['old'].items())]))
+    return '%s: %s -> %s' % (effect['file'], effect['new'], effect['old'])
+
+
+def rollback_release(run=None, dry_run='no'):
+    """Undo the side effects of the last release, or of the given run in
+    the release journal
+
+    The tags made by mkrelease and tag_buildout are deleted, at the same
+    time, and the version bumps, versions.cfg pins and buildout version are
+    put back and committed. Uploads can't be undone and are only listed.
+    Running it again after a failure carries on with what is left.
+    """
+    journal = api.env.release_journal
+    entries = _read_journal(journal)
+    if run is None:
+        runs = [entry['run'] for entry in entries
+                if entry['action'] != 'undo']
+        if not runs:
+            api.abort("There is no release in %s" % journal)
+        run = runs[-1]
+    effects = _remaining_effects(entries, run)
+    if not effects:
+        print colors.yellow("Nothing left to undo for %s" % run)
+        return
+    tags = [effect for effect in effects if effect['action'] in TAG_EFFECTS]
+    edits = [effect for effect in effects
+             if effect['action'] in EDIT_EFFECTS]
+    commits = [effect for effect in effects if effect['action'] == 'commit']
+    committed = set()
+    for effect in commits:
+        committed.update([os.path.realpath(path)
+                          for path in effect['files']])
+
+    print colors.blue("Rolling back %s" % run)
+    for effect in tags:
+        print "Delete tag %s of %s" % (effect['version'], effect['path'])
+    for effect in edits:
+        print "Revert %s" % _describe_edit(effect)
+    uploads = [effect for effect in entries
+               if effect.get('run') == run and effect['action'] == 'release']
+    for effect in uploads:
+        print colors.red("Can't undo the upload of %s %s to %s" % (
+            effect['package'], effect['version'], effect['target']))
+    if dry_run.lower() in TRUISMS:
+        return
+
+    api.env.scm_factory = SCMFactory()
+    failed = []
+    for effect, tagid, rc, lines in _run_pool(_delete_tag, tags,
+                                              api.env.scm_threads):
+        if rc != 0:
+            print colors.red("Deleting %s failed:\n%s" % (tagid,
+                                                          "\n".join(lines)))
+            failed.append(tagid)
+            continue
+        release._invalidate_tag_index(effect['path'])
+        _mark_undone(run, effect)
+
+    changes = []
+    for effect in reversed(edits):
+        _revert_edit(effect)
+        if os.path.realpath(effect['file']) not in committed:
+            continue
+        name = effect.get('package', os.path.basename(effect['file']))
+        version = effect['old']
+        if effect['action'] == 'edit_pins':
+            version = 'pins'
+        changes.append((os.path.dirname(effect['file']), [effect['file']],
+                        name, version))
+    if changes:
+        release._commit_changes(changes, 'Back out', record=False)
+    for effect in edits + commits:
+        _mark_undone(run, effect)
+    if failed:
+        api.abort("Couldn't delete %s, run rollback_release again to retry" %
+                  ", ".join(failed))
@@ -1,8 +1,67 @@
+import os
+import re
+import subprocess
+import threading
 from os import linesep
 from os.path import isdir
 
 from jarn.mkrelease.scm import Subversion, Mercurial, Git
 
+# The hg and git commands below change directory in the shell they run in
+# rather than using the dirstack, so they are safe to call from threads.
+
+HG_NULLID = '0' * 40
+HG_TAG_CACHES = ['tags2-visible', 'tags2', 'tags']
+# colordiff and git --color wrap the diff headers in escape sequences
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+# HEAD revision of each svn repository, asked once per run
+_svn_revisions = {}
+_svn_revisions_lock = threading.Lock()
+
+
+def _stream_command(cmd):
+    """Yield the output of a shell command line by line as it is produced.
+
+    Closing the generator early stops the command.
+    """
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                            stderr=devnull)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            yield line.rstrip('\r\n')
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.stdout.close()
+        proc.wait()
+        devnull.close()
+
+
+def _limit_diff(lines, file_markers, max_lines=0, max_files=0):
+    """Pass diff lines through, stopping after `max_lines` lines or
+    `max_files` files. A limit of 0 means no limit.
+    """
+    line_count = 0
+    file_count = 0
+    try:
+        for line in lines:
+            if (max_files and
+              ANSI_ESCAPE.sub('', line).startswith(file_markers)):
+                file_count += 1
+                if file_count > max_files:
+                    yield '... diff stopped after %s files' % max_files
+                    return
+            line_count += 1
+            if max_lines and line_count > max_lines:
+                yield '... diff stopped after %s lines' % max_lines
+                return
+            yield line
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+
+
 def list_svn_tags(self, dir):
     base_url = self.get_base_url_from_sandbox(dir)
     layout = self.get_layout_from_sandbox(dir)
@@ -21,63 +80,391 @@ def diff_svn_tag(self, dir, tagid, use_colordiff=True):
     return linesep.join([line for line in lines if rc == 0])
 
 
-def list_hg_tags(self, dir):
+def iter_svn_diff_tag(self, dir, tagid, use_colordiff=True, max_lines=0,
+                      max_files=0, stat=False):
+    url = self.get_url_from_sandbox(dir)
+    if stat:
+        cmd = 'svn diff --summarize "%(tagid)s" "%(url)s"' % locals()
+    else:
+        cmd = 'svn diff "%(tagid)s" "%(url)s"' % locals()
+        if use_colordiff:
+            cmd += ' | colordiff'
+    return _limit_diff(_stream_command(cmd), ('Index: ',), max_lines,
+                      max_files)
+
+
+def svn_tag_index_key(self, dir):
+    """The HEAD revision of the repository, so tags made from another
+    checkout are seen without an svn up. It is asked once per run for all
+    the working copies in the same repository.
+    """
+    rc, lines = self.process.popen('svn info "%(dir)s"' % locals(),
+                                   echo=False)
+    root = None
+    for line in lines:
+        if line.startswith('Repository Root:'):
+            root = line.split(':', 1)[1].strip()
+    if rc != 0 or root is None:
+        return None
+    with _svn_revisions_lock:
+        if root not in _svn_revisions:
+            revision = None
+            rc, lines = self.process.popen('svn info "%(root)s"' % locals(),
+                                           echo=False)
+            for line in lines:
+                if rc == 0 and line.startswith('Revision:'):
+                    revision = line.split(':', 1)[1].strip()
+            _svn_revisions[root] = revision
+        return _svn_revisions[root]
+
+
+def list_hg_tags_command(self, dir):
     if isdir(dir):
-        self.dirstack.push(dir)
-        try:
-            rc, lines = self.process.popen(
-                'hg tags', echo=False)
-            return [line for line in lines if rc == 0]
-        finally:
-            self.dirstack.pop()
+        rc, lines = self.process.popen(
+            'cd "%(dir)s" && hg tags' % locals(), echo=False)
+        if rc != 0:
+            return []
+        # lines look like "1.0                5:b7bd8b1ae5b6"
+        tags = [line.rsplit(None, 1)[0].strip()
+                for line in lines if line.strip()]
+        return [tag for tag in tags if tag != 'tip']
     else:
         return []
 
 
+def list_hg_tags(self, dir):
+    tags = _read_hg_tags(dir)
+    if tags is None:
+        tags = self.list_tags_command(dir)
+    return tags
+
+
 def diff_hg_tag(self, dir, tagid):
     if isdir(dir):
-        self.dirstack.push(dir)
-        try:
-            url = self.get_url_from_sandbox(dir)
-            rc, lines = self.process.popen(
-                'hg diff -r "%(tagid)s"' % locals(), echo=False)
-            return linesep.join([line for line in lines if rc == 0])
-        finally:
-            self.dirstack.pop()
+        rc, lines = self.process.popen(
+            'cd "%(dir)s" && hg diff -r "%(tagid)s"' % locals(), echo=False)
+        return linesep.join([line for line in lines if rc == 0])
     else:
         return ''
 
 
-def list_git_tags(self, dir):
+def iter_hg_diff_tag(self, dir, tagid, max_lines=0, max_files=0,
+                     stat=False):
+    if not isdir(dir):
+        return _limit_diff(iter([]), ())
+    option = stat and '--stat ' or ''
+    cmd = 'cd "%(dir)s" && hg diff %(option)s-r "%(tagid)s"' % locals()
+    return _limit_diff(_stream_command(cmd), ('diff -r', 'diff --git'),
+                      max_lines, max_files)
+
+
+def hg_tag_index_key(self, dir):
+    """The node of the repository tip
+    """
+    if not isdir(dir):
+        return None
+    rc, lines = self.process.popen(
+        'cd "%(dir)s" && hg tip --template "{node}"' % locals(), echo=False)
+    if rc != 0 or not lines:
+        return None
+    return lines[0].strip()
+
+
+def list_git_tags_command(self, dir):
     if isdir(dir):
-        self.dirstack.push(dir)
-        try:
-            rc, lines = self.process.popen(
-                'git tag', echo=False)
-            return [line for line in lines if rc == 0]
-        finally:
-            self.dirstack.pop()
+        rc, lines = self.process.popen(
+            'cd "%(dir)s" && git tag' % locals(), echo=False)
+        return [line for line in lines if rc == 0]
     else:
         return []
 
 
+def list_git_tags(self, dir):
+    tags = _read_git_tags(dir)
+    if tags is None:
+        tags = self.list_tags_command(dir)
+    return tags
+
+
 def diff_git_tag(self, dir, tagid):
     if isdir(dir):
-        self.dirstack.push(dir)
-        try:
-            rc, lines = self.process.popen(
-                'git diff --color=always "%(tagid)s" HEAD' % locals(),
-                echo=False)
-            return linesep.join([line for line in lines if rc == 0])
-        finally:
-            self.dirstack.pop()
+        rc, lines = self.process.popen(
+            'cd "%(dir)s" && git diff --color=always "%(tagid)s" HEAD'
+            % locals(), echo=False)
+        return linesep.join([line for line in lines if rc == 0])
     else:
         return ''
 
 
+def iter_git_diff_tag(self, dir, tagid, max_lines=0, max_files=0,
+                      stat=False):
+    if not isdir(dir):
+        return _limit_diff(iter([]), ())
+    option = stat and '--stat ' or ''
+    cmd = ('cd "%(dir)s" && '
+           'git diff --color=always %(option)s"%(tagid)s" HEAD' % locals())
+    return _limit_diff(_stream_command(cmd), ('diff --git',), max_lines,
+                      max_files)
+
+
+def _find_git_dir(dir):
+    """Find the git directory holding the refs for a working copy, or None
+    if the layout isn't one we know how to read
+    """
+    dir = os.path.abspath(dir)
+    while True:
+        git_path = os.path.join(dir, '.git')
+        if isdir(git_path):
+            return git_path
+        if os.path.isfile(git_path):
+            # worktrees and submodules point at their git dir
+            with open(git_path) as f:
+                line = f.readline().strip()
+            if not line.startswith('gitdir:'):
+                return None
+            git_dir = os.path.join(dir, line[len('gitdir:'):].strip())
+            commondir = os.path.join(git_dir, 'commondir')
+            if os.path.isfile(commondir):
+                with open(commondir) as f:
+                    git_dir = os.path.join(git_dir, f.read().strip())
+            git_dir = os.path.normpath(git_dir)
+            if not isdir(git_dir):
+                return None
+            return git_dir
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+
+
+def git_tag_index_key(self, dir):
+    """The mtimes of the tag refs and packed-refs
+    """
+    git_dir = _find_git_dir(dir)
+    if git_dir is None:
+        return None
+    key = []
+    packed_refs = os.path.join(git_dir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        key.append(os.stat(packed_refs).st_mtime)
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    for dirpath, dirnames, filenames in os.walk(tags_dir):
+        key.append(os.stat(dirpath).st_mtime)
+        key.append(len(filenames))
+    return tuple(key)
+
+
+def _read_git_tags(dir):
+    """Read the tag names straight from the loose refs and packed-refs.
+
+    Returns None when the repository layout isn't understood, so the caller
+    can fall back to `git tag`.
+    """
+    git_dir = _find_git_dir(dir)
+    if git_dir is None or not isdir(os.path.join(git_dir, 'refs')):
+        return None
+    tags = set()
+    packed_refs = os.path.join(git_dir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                line = line.strip()
+                # skip the header and peeled tag lines
+                if not line or line.startswith('#') or line.startswith('^'):
+                    continue
+                parts = line.split()
+                if len(parts) != 2:
+                    return None
+                if parts[1].startswith('refs/tags/'):
+                    tags.add(parts[1][len('refs/tags/'):])
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    for dirpath, dirnames, filenames in os.walk(tags_dir):
+        relpath = os.path.relpath(dirpath, tags_dir)
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            if relpath != os.curdir:
+                filename = os.path.join(relpath, filename)
+            tags.add(filename.replace(os.sep, '/'))
+    return sorted(tags)
+
+
+def _find_hg_root(dir):
+    dir = os.path.abspath(dir)
+    while not isdir(os.path.join(dir, '.hg')):
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+    return dir
+
+
+def _read_hg_tag_file(path, tags, skip_first=False):
+    with open(path) as f:
+        lines = f.readlines()
+    if skip_first:
+        lines = lines[1:]
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        node, name = line.split(' ', 1)
+        if node == HG_NULLID:
+            # tag was removed
+            tags.pop(name.strip(), None)
+        else:
+            tags[name.strip()] = node
+
+
+def _read_hg_tags(dir):
+    """Read the tag names from .hgtags and .hg/localtags, or from the
+    tags cache when there is no .hgtags in the working copy.
+
+    Returns None when the repository layout isn't understood, so the caller
+    can fall back to `hg tags`.
+    """
+    root = _find_hg_root(dir)
+    if root is None:
+        return None
+    tags = {}
+    hgtags = os.path.join(root, '.hgtags')
+    try:
+        if os.path.exists(hgtags):
+            _read_hg_tag_file(hgtags, tags)
+        else:
+            for cache_name in HG_TAG_CACHES:
+                cache = os.path.join(root, '.hg', 'cache', cache_name)
+                if os.path.exists(cache):
+                    _read_hg_tag_file(cache, tags, skip_first=True)
+                    break
+        localtags = os.path.join(root, '.hg', 'localtags')
+        if os.path.exists(localtags):
+            _read_hg_tag_file(localtags, tags)
+    except ValueError:
+        return None
+    return sorted(tags)
+
+
+
+def svn_sandbox_root(self, dir):
+    """The top directory of the working copy dir is in
+    """
+    rc, lines = self.process.popen('svn info "%(dir)s"' % locals(),
+                                   echo=False)
+    if rc == 0:
+        for line in lines:
+            if line.startswith('Working Copy Root Path:'):
+                return line.split(':', 1)[1].strip()
+    # before svn 1.7 every directory of a working copy has a .svn
+    dir = os.path.abspath(dir)
+    parent = os.path.dirname(dir)
+    while parent != dir and isdir(os.path.join(parent, '.svn')):
+        dir, parent = parent, os.path.dirname(parent)
+    return dir
+
+
+def _quote_paths(paths):
+    return ' '.join(['"%s"' % path for path in paths])
+
+
+def commit_svn_paths(self, root, paths, message, push=True):
+    """Commit the paths, relative to the working copy root, in one commit
+    """
+    paths = _quote_paths(paths)
+    return self.process.popen(
+        'cd "%(root)s" && svn commit -m "%(message)s" %(paths)s' % locals(),
+        echo=False)
+
+
+def hg_sandbox_root(self, dir):
+    return _find_hg_root(dir) or os.path.abspath(dir)
+
+
+def commit_hg_paths(self, root, paths, message, push=True):
+    paths = _quote_paths(paths)
+    rc, lines = self.process.popen(
+        'cd "%(root)s" && hg status %(paths)s' % locals(), echo=False)
+    # nothing left to commit when an earlier attempt committed but couldn't
+    # push, so only push
+    if rc != 0 or lines:
+        rc, lines = self.process.popen(
+            'cd "%(root)s" && hg commit -m "%(message)s" %(paths)s' %
+            locals(), echo=False)
+    if rc == 0 and push:
+        rc, push_lines = self.process.popen('cd "%(root)s" && hg push' %
+                                            locals(), echo=False)
+        lines = lines + push_lines
+        # hg push exits with 1 when there is nothing to push
+        if rc == 1:
+            rc = 0
+    return rc, lines
+
+
+def git_sandbox_root(self, dir):
+    rc, lines = self.process.popen(
+        'cd "%(dir)s" && git rev-parse --show-toplevel' % locals(),
+        echo=False)
+    if rc == 0 and lines:
+        return lines[0].strip()
+    return os.path.abspath(dir)
+
+
+def commit_git_paths(self, root, paths, message, push=True):
+    paths = _quote_paths(paths)
+    rc, lines = self.process.popen(
+        'cd "%(root)s" && git diff --quiet HEAD -- %(paths)s' % locals(),
+        echo=False)
+    # nothing left to commit when an earlier attempt committed but couldn't
+    # push, so only push
+    if rc != 0:
+        rc, lines = self.process.popen(
+            'cd "%(root)s" && git commit -m "%(message)s" -- %(paths)s' %
+            locals(), echo=False)
+    if rc == 0 and push:
+        rc, push_lines = self.process.popen('cd "%(root)s" && git push' %
+                                            locals(), echo=False)
+        lines = lines + push_lines
+    return rc, lines
+
+
+def delete_svn_tag(self, dir, tagid):
+    return self.process.popen(
+        'svn remove -m "Remove tag %(tagid)s." "%(tagid)s"' % locals(),
+        echo=False)
+
+
+def delete_hg_tag(self, dir, tagid):
+    # removing a tag is a commit in hg
+    return self.process.popen(
+        'cd "%(dir)s" && hg tag --remove "%(tagid)s" && hg push' % locals(),
+        echo=False)
+
+
+def delete_git_tag(self, dir, tagid):
+    return self.process.popen(
+        'cd "%(dir)s" && git tag -d "%(tagid)s" && '
+        'git push origin ":refs/tags/%(tagid)s"' % locals(), echo=False)
+
 Subversion.list_tags = list_svn_tags
 Subversion.diff_tag = diff_svn_tag
+Subversion.iter_diff_tag = iter_svn_diff_tag
 Mercurial.list_tags = list_hg_tags
+Mercurial.list_tags_command = list_hg_tags_command
 Mercurial.diff_tag = diff_hg_tag
+Mercurial.iter_diff_tag = iter_hg_diff_tag
 Git.list_tags = list_git_tags
+Git.list_tags_command = list_git_tags_command
 Git.diff_tag = diff_git_tag
+Git.iter_diff_tag = iter_git_diff_tag
+Subversion.get_tag_index_key = svn_tag_index_key
+Mercurial.get_tag_index_key = hg_tag_index_key
+Git.get_tag_index_key = git_tag_index_key
+Subversion.get_sandbox_root = svn_sandbox_root
+Mercurial.get_sandbox_root = hg_sandbox_root
+Git.get_sandbox_root = git_sandbox_root
+Subversion.commit_paths = commit_svn_paths
+Mercurial.commit_paths = commit_hg_paths
+Git.commit_paths = commit_git_paths
+Subversion.delete_tag = delete_svn_tag
+Mercurial.delete_tag = delete_hg_tag
+Git.delete_tag = delete_git_tag
@@ -0,0 +1,37 @@
+import os
+import time
+
+from sixfeetup.deployment.journal import _append_journal
+from sixfeetup.deployment.journal import _read_journal
+
+# Bump this when the entries change in a way older code can't read
+STATE_FORMAT = 1
+
+
+def _read_state(path):
+    """Replay the state log into the package info of each package, with
+    the status and time of each step under 'steps'. Returns None when there
+    is no state or it is in another format.
+    """
+    entries = _read_journal(path)
+    if not entries or entries[0].get('format') != STATE_FORMAT:
+        return None
+    packages = {}
+    for entry in entries[1:]:
+        package = packages.setdefault(entry['package'], {'steps': {}})
+        package.update(entry['info'])
+        package['steps'][entry['step']] = {'status': entry['status'],
+                                           'time': entry['time']}
+    return packages
+
+
+def _record_state(state_file, package, step, status='done', **info):
+    """Add the outcome of a step for a package to the state log, along
+    with the package info that changed
+    """
+    if not os.path.exists(state_file):
+        _append_journal(state_file, {'format': STATE_FORMAT,
+                                     'time': time.time()})
+    _append_journal(state_file, {'package': package, 'step': step,
+                                 'status': status, 'time': time.time(),
+                                 'info': info})
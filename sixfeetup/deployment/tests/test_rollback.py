@@ -0,0 +1,156 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from fabric import api
+
+# sets the defaults of the settings
+from sixfeetup.deployment import commands
+from sixfeetup.deployment import release
+from sixfeetup.deployment import rollback
+from sixfeetup.deployment.journal import _read_journal
+
+
+def git(cwd, *args):
+    return subprocess.check_output(('git',) + args, cwd=cwd,
+                                   stderr=subprocess.STDOUT)
+
+
+class RollbackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.env = dict(api.env)
+        api.env.release_journal = os.path.join(self.tmp, 'journal')
+        api.env.tag_index = ''
+        api.env.scm_threads = 2
+        api.env.scm_batch_commits = True
+        release._journal_run = None
+
+    def tearDown(self):
+        api.env.clear()
+        api.env.update(self.env)
+        release._journal_run = None
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+
+class RemainingEffectsTest(RollbackTestCase):
+
+    def test_undone_and_other_runs_are_left_out(self):
+        entries = [
+            {'run': 'a', 'id': 'a-1', 'action': 'tag'},
+            {'run': 'a', 'id': 'a-2', 'action': 'edit_buildout_version'},
+            {'run': 'b', 'id': 'b-1', 'action': 'tag'},
+            {'run': 'a', 'action': 'undo', 'effect': 'a-1'},
+        ]
+        remaining = rollback._remaining_effects(entries, 'a')
+        self.assertEqual([effect['id'] for effect in remaining], ['a-2'])
+
+    def test_nothing_left(self):
+        entries = [
+            {'run': 'a', 'id': 'a-1', 'action': 'tag'},
+            {'run': 'a', 'action': 'undo', 'effect': 'a-1'},
+        ]
+        self.assertEqual(rollback._remaining_effects(entries, 'a'), [])
+
+
+class RevertEditTest(RollbackTestCase):
+
+    def test_edit_version(self):
+        path = self.write('setup.py', "version = '1.1'\n")
+        rollback._revert_edit({
+            'action': 'edit_version', 'file': path,
+            'version_re': release.SETUPPY_VERSION, 'old': '1.0',
+            'new': '1.1'})
+        self.assertEqual(self.read(path), "version = '1.0'\n")
+
+    def test_edit_pins(self):
+        path = self.write('versions.cfg',
+                          "[versions]\nfoo = 1.1 # pinned\nbar = 2.1\n")
+        rollback._revert_edit({
+            'action': 'edit_pins', 'file': path,
+            'old': {'foo': '1.0', 'bar': None},
+            'new': {'foo': '1.1', 'bar': '2.1'}})
+        self.assertEqual(self.read(path), "[versions]\nfoo = 1.0 # pinned\n")
+
+    def test_edit_buildout_version(self):
+        path = self.write('version.txt', '1.1')
+        rollback._revert_edit({
+            'action': 'edit_buildout_version', 'file': path, 'old': '1.0',
+            'new': '1.1'})
+        self.assertEqual(self.read(path), '1.0')
+
+
+class GitRoundTripTest(RollbackTestCase):
+    """Tag and bump a buildout with a local bare repository as the remote
+    and roll it back
+    """
+
+    def setUp(self):
+        super(GitRoundTripTest, self).setUp()
+        self.remote = os.path.join(self.tmp, 'remote.git')
+        self.wc = os.path.join(self.tmp, 'buildout')
+        git(self.tmp, 'init', '-q', '--bare', self.remote)
+        git(self.tmp, 'clone', '-q', self.remote, self.wc)
+        git(self.wc, 'config', 'user.email', 'test@example.com')
+        git(self.wc, 'config', 'user.name', 'Test')
+        with open(os.path.join(self.wc, 'version.txt'), 'w') as f:
+            f.write('1.0')
+        git(self.wc, 'add', 'version.txt')
+        git(self.wc, 'commit', '-q', '-m', 'Start')
+        git(self.wc, 'push', '-q', '-u', 'origin', 'HEAD')
+        self.cwd = os.getcwd()
+        os.chdir(self.wc)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        super(GitRoundTripTest, self).tearDown()
+
+    def test_tag_and_bump_are_undone(self):
+        # what tag_buildout does, with the tag made by git itself
+        git(self.wc, 'tag', '1.0')
+        git(self.wc, 'push', '-q', 'origin', '1.0')
+        release._record_effect('tag', path=self.wc, version='1.0')
+        api.env.scm_factory = rollback.SCMFactory()
+        release._commit_changes([release._bump_buildout_version('1.0')])
+        self.assertEqual(git(self.remote, 'tag').split(), ['1.0'])
+
+        rollback.rollback_release()
+
+        self.assertEqual(git(self.wc, 'tag').split(), [])
+        self.assertEqual(git(self.remote, 'tag').split(), [])
+        self.assertEqual(self.read('version.txt'), '1.0')
+        self.assertEqual(
+            git(self.remote, 'show', 'HEAD:version.txt'), '1.0')
+        self.assertTrue(
+            git(self.remote, 'log', '-1', '--format=%s').startswith(
+                'Back out'))
+        entries = _read_journal(api.env.release_journal)
+        self.assertEqual(
+            rollback._remaining_effects(entries, release._journal_run), [])
+
+    def test_tag_of_failed_release_is_undone(self):
+        # mkrelease tagged the package, then the upload failed
+        git(self.wc, 'tag', '1.0')
+        git(self.wc, 'push', '-q', 'origin', '1.0')
+        api.env.scm_factory = rollback.SCMFactory()
+        api.env.package_info = {'my.package': {'path': self.wc,
+                                               'version': '1.0'}}
+        release._record_failed_release('my.package')
+
+        rollback.rollback_release()
+
+        self.assertEqual(git(self.wc, 'tag').split(), [])
+        self.assertEqual(git(self.remote, 'tag').split(), [])
@@ -0,0 +1,228 @@
+import glob
+import os
+import time
+
+try:
+    from hashlib import sha256
+except ImportError:
+    sha256 = None
+
+from fabric import api
+
+from sixfeetup.deployment.parallel import _run_pool
+from sixfeetup.deployment.utils import (_local_run,
+                                        _sshagent_command)
+
+# Don't split files into chunks smaller than this
+MIN_CHUNK_SIZE = 32 * 1024 * 1024
+FAN_OUT_MODES = ['serial', 'parallel', 'tree']
+
+
+def _remote_size(path):
+    with api.settings(api.hide('running', 'stdout', 'warnings'),
+                      warn_only=True):
+        result = api.run('wc -c < %s' % path)
+    if result.failed or not result.strip().isdigit():
+        api.abort("Couldn't get the size of %s" % path)
+    return int(result.strip())
+
+
+def _remote_checksum(path):
+    """The checksum from the manifest written next to the file, or None
+    """
+    with api.settings(api.hide('running', 'stdout', 'warnings'),
+                      warn_only=True):
+        result = api.run('cat %s.sha256' % path)
+    if result.failed or not result.strip():
+        return None
+    return result.split()[0]
+
+
+def _write_checksum(path):
+    """Write the checksum manifest for a file, call this on the host that
+    has the file
+    """
+    dirname, filename = os.path.split(path)
+    with api.cd(dirname):
+        return api.run('%s %s > %s.sha256' % (
+            api.env.data_checksum_command, filename, filename))
+
+
+def _local_checksum(path):
+    digest = sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fetch_chunk(chunk):
+    """Fetch a byte range of a remote file into a local part file, resuming
+    from what the part file already holds
+    """
+    host_string, remote_path, part_path, offset, length = chunk
+    have = 0
+    if os.path.exists(part_path):
+        have = os.path.getsize(part_path)
+    if have > length:
+        os.unlink(part_path)
+        have = 0
+    if have == length:
+        return part_path, 0, ''
+    # tail counts from 1
+    command = 'tail -c +%s %s | head -c %s' % (offset + have + 1,
+                                               remote_path,
+                                               length - have)
+    # streams multiplexed over the master connection would share its TCP
+    # window, so each one opens its own
+    rc, output = _local_run('%s >> %s' % (
+        _sshagent_command(command, host_string, control=False), part_path))
+    if rc == 0 and os.path.getsize(part_path) != length:
+        rc, output = 1, 'got %s of %s bytes' % (
+            os.path.getsize(part_path), length)
+    return part_path, rc, output
+
+
+def _download(remote_path, local_path, streams=1):
+    """Download a file from the current host over several ssh streams.
+
+    Each stream fetches a byte range into its own part file, so an
+    interrupted download picks up where it stopped. The result is checked
+    against the checksum manifest on the host when there is one, and a
+    local file that already matches it isn't downloaded again.
+    """
+    host_string = api.env.host_string
+    size = _remote_size(remote_path)
+    checksum = _remote_checksum(remote_path)
+    if checksum is None:
+        api.puts('No checksum for %s, the download will not be verified' %
+                 remote_path)
+    elif sha256 is None:
+        api.puts('hashlib is not available, the download will not be '
+                 'verified')
+        checksum = None
+    if (checksum is not None and os.path.exists(local_path) and
+      os.path.getsize(local_path) == size and
+      _local_checksum(local_path) == checksum):
+        api.puts('%s is already downloaded' % local_path)
+        return local_path
+
+    streams = max(1, min(int(streams), size // MIN_CHUNK_SIZE or 1))
+    chunk_size = max(1, -(-size // streams))
+    chunks = []
+    for offset in range(0, size, chunk_size):
+        length = min(chunk_size, size - offset)
+        part_path = '%s.part.%s-%s' % (local_path, offset, length)
+        chunks.append((host_string, remote_path, part_path, offset, length))
+    # parts from an earlier download with a different number of streams
+    part_paths = [chunk[2] for chunk in chunks]
+    for part_path in glob.glob('%s.part.*' % local_path):
+        if part_path not in part_paths:
+            os.unlink(part_path)
+
+    start = time.time()
+    api.puts('Downloading %s (%.1f MB) in %s streams' % (
+        remote_path, size / 1024.0 / 1024, len(chunks)))
+    results = _run_pool(_fetch_chunk, chunks, len(chunks))
+    failed = [(part_path, output)
+              for part_path, rc, output in results if rc != 0]
+    if failed:
+        for part_path, output in failed:
+            api.puts('Downloading %s failed:\n%s' % (part_path, output))
+        api.abort('Download of %s failed, run it again to resume' %
+                  remote_path)
+
+    tmp_path = '%s.part' % local_path
+    with open(tmp_path, 'wb') as f:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                while True:
+                    block = part.read(1024 * 1024)
+                    if not block:
+                        break
+                    f.write(block)
+    if checksum is not None and _local_checksum(tmp_path) != checksum:
+        os.unlink(tmp_path)
+        for part_path in part_paths:
+            os.unlink(part_path)
+        api.abort('Checksum mismatch for %s, the download was removed' %
+                  remote_path)
+    os.rename(tmp_path, local_path)
+    for part_path in part_paths:
+        os.unlink(part_path)
+    elapsed = time.time() - start
+    api.puts('Downloaded %s in %.1fs (%.1f MB/s)' % (
+        local_path, elapsed, size / 1024.0 / 1024 / max(elapsed, 0.001)))
+    return local_path
+
+
+def _push_file(push):
+    """Have the target host pull a file from the source host with rsync,
+    using an older file in the target directory as the basis if there is
+    one
+    """
+    source_host, source_path, target_host, target_dir = push
+    start = time.time()
+    command = 'rsync -t --partial --fuzzy %s:%s %s/' % (
+        source_host, source_path, target_dir)
+    rc, output = _local_run(_sshagent_command(command, target_host))
+    return target_host, rc, output, time.time() - start
+
+
+def _fan_out_rounds(source_host, target_hosts, mode):
+    """Plan which host copies to which in each round.
+
+    serial copies from the source to one host at a time, parallel copies to
+    all of them at once. tree only sends the file from the source once and
+    then every host that has it passes it on to another one, so the number
+    of copies doubles every round.
+    """
+    target_hosts = list(target_hosts)
+    if mode == 'serial':
+        return [[(source_host, host)] for host in target_hosts]
+    if mode == 'parallel':
+        return [[(source_host, host) for host in target_hosts]]
+    rounds = []
+    have_file = []
+    while target_hosts:
+        # the source host only sends the file once
+        sources = have_file or [source_host]
+        current_round = []
+        for source in sources:
+            if not target_hosts:
+                break
+            current_round.append((source, target_hosts.pop(0)))
+        rounds.append(current_round)
+        have_file.extend([target for source, target in current_round])
+    return rounds
+
+
+def _fan_out(source_host, source_path, target_hosts, target_dir, mode):
+    """Copy a file from the source host to the target directory on all the
+    target hosts. Returns the seconds each host took.
+    """
+    if mode not in FAN_OUT_MODES:
+        api.abort('Unknown mode "%s", use one of: %s' % (
+            mode, ', '.join(FAN_OUT_MODES)))
+    target_path = os.path.join(target_dir, os.path.basename(source_path))
+    timings = []
+    for pushes in _fan_out_rounds(source_host, target_hosts, mode):
+        pushes = [
+            (source, source == source_host and source_path or target_path,
+             target, target_dir)
+            for source, target in pushes]
+        for source, path, target, target_dir in pushes:
+            api.puts('%s -> %s: %s' % (source, target, path))
+        results = _run_pool(_push_file, pushes, len(pushes))
+        failed = False
+        for target, rc, output, seconds in results:
+            if rc != 0:
+                api.puts('Copying to %s failed:\n%s' % (target, output))
+                failed = True
+            timings.append((target, seconds))
+        if failed:
+            api.abort('Copying %s failed' % source_path)
+    return timings
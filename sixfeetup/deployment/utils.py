@@ -1,6 +1,11 @@
+import atexit
+import os
+import subprocess
+import threading
+
 from fabric import api
-from fabric import contrib
 from fabric.operations import _shell_escape
+from fabric.operations import _sudo_prefix
 from fabric.state import output
 
 TRUISMS = [
@@ -13,6 +18,9 @@ TRUISMS = [
 ]
 GLOBAL_IGNORES = ['.svn', 'CVS', '.AppleDouble', '.git']
 YES_OR_NO = ['yes', 'y', 'no', 'n']
+# hosts with an ssh master connection to close on exit
+_control_hosts = set()
+_control_lock = threading.Lock()
 
 
 def _quiet_remote_ls(path, fname_filter):
@@ -23,21 +31,80 @@ def _quiet_remote_ls(path, fname_filter):
 
 
 def _quiet_remote_mkdir(path):
-    if contrib.files.exists(path):
-        return
+    # one round-trip instead of checking with contrib.files.exists first,
+    # still only using sudo when the directory has to be created
     with api.settings(api.hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=True):
-        return api.sudo('mkdir -p %s' % path)
+        return api.run('test -d %s || %smkdir -p %s' % (
+            path, _sudo_prefix(None), path))
 
 
-def _sshagent_run(command, shell=True, pty=True):
+def _remote_batch(commands, use_sudo=False):
     """
     Helper function.
-    Runs a command with SSH agent forwarding enabled.
+    Runs several commands on the current host in one round-trip and returns
+    an (exit code, output) pair for each of them.
+    """
+    marker = '--sfup-%s--' % os.urandom(8).encode('hex')
+    script = []
+    for i, command in enumerate(commands):
+        script.append('echo "%s start"; ( %s ) 2>&1; echo "%s end $?"' % (
+            marker, command, marker))
+    runner = use_sudo and api.sudo or api.run
+    with api.settings(api.hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True):
+        result = runner('; '.join(script))
+    results = []
+    lines = None
+    for line in result.splitlines():
+        line = line.rstrip('\r')
+        if line == '%s start' % marker:
+            lines = []
+        elif line.startswith('%s end ' % marker):
+            results.append((int(line.split()[-1]), '\n'.join(lines)))
+            lines = None
+        elif lines is not None:
+            lines.append(line)
+    if len(results) != len(commands):
+        api.abort("Couldn't run the commands on %s:\n%s" % (
+            api.env.host_string, result))
+    return results
 
-    Note:: Fabric (and paramiko) can't forward your SSH agent.
-    This helper uses your system's ssh to do so.
+
+def _ssh_control_options(host_string):
+    """
+    Helper function.
+    The ssh options that share one master connection per host for the
+    lifetime of this process.
+    """
+    if not api.env.ssh_control_path:
+        return ''
+    control_path = api.env.ssh_control_path % {'pid': os.getpid()}
+    with _control_lock:
+        if not _control_hosts:
+            atexit.register(_close_ssh_masters, control_path)
+        _control_hosts.add(host_string)
+    return ('-o ControlMaster=auto -o ControlPath=%s '
+            '-o ControlPersist=%s ' % (control_path,
+                                       api.env.ssh_control_persist))
+
+
+def _close_ssh_masters(control_path):
+    for host_string in _control_hosts:
+        subprocess.call(
+            'ssh -o ControlPath=%s -O exit %s >/dev/null 2>&1' % (
+                control_path, host_string), shell=True)
+
+
+def _sshagent_command(command, host_string=None, shell=True, control=True):
+    """
+    Helper function.
+    Returns the local ssh command line that runs a command on a host with
+    SSH agent forwarding enabled. With control off the command gets its
+    own connection instead of the shared master one.
     """
+    if host_string is None:
+        host_string = api.env.host_string
     real_command = command
     if shell:
         cwd = api.env.get('cwd', '')
@@ -45,11 +112,39 @@ def _sshagent_run(command, shell=True, pty=True):
             cwd = 'cd %s && ' % _shell_escape(cwd)
         real_command = '%s "%s"' % (api.env.shell,
             _shell_escape(cwd + real_command))
+    options = '-o ControlPath=none '
+    if control:
+        options = _ssh_control_options(host_string)
+    return "ssh -A %s%s '%s'" % (options, host_string, real_command)
+
+
+def _sshagent_run(command, shell=True, pty=True):
+    """
+    Helper function.
+    Runs a command with SSH agent forwarding enabled.
+
+    Note:: Fabric (and paramiko) can't forward your SSH agent.
+    This helper uses your system's ssh to do so.
+    """
     if output.debug:
-        print("[%s] run: %s" % (api.env.host_string, real_command))
+        print("[%s] run: %s" % (api.env.host_string,
+                                _sshagent_command(command, shell=shell)))
     elif output.running:
         print("[%s] run: %s" % (api.env.host_string, command))
     with api.settings(api.hide('warnings', 'running', 'stdout', 'stderr'),
                   warn_only=True):
-        return api.local(
-            "ssh -A %s '%s'" % (api.env.host_string, real_command))
+        return api.local(_sshagent_command(command, shell=shell))
+
+
+def _local_run(command):
+    """
+    Helper function.
+    Runs a local shell command and returns the exit code and the output.
+
+    Unlike api.local this doesn't touch Fabric's global state, so it can be
+    called from threads.
+    """
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    stdout = proc.communicate()[0]
+    return proc.returncode, stdout
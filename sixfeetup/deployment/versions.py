@@ -0,0 +1,119 @@
+import os
+import re
+import stat
+import tempfile
+
+# A pin, split so the version can be replaced and everything around it,
+# including an inline comment, is kept as it is
+PIN_LINE_RE = re.compile(
+    r'^(\s*([A-Za-z0-9_.\-]+)\s*=\s*)(\S+)(\s+[#;].*)?(\s*)$')
+SECTION_RE = re.compile(r'^\[([^\]]+)\]')
+
+
+def _pin_key(name):
+    """setuptools doesn't care about case, or about - and _
+    """
+    return name.lower().replace('_', '-')
+
+
+def _index_pins(lines):
+    """Map each pinned package to the numbers of the lines that pin it.
+    Options of the [buildout] section aren't pins.
+    """
+    index = {}
+    section = None
+    for number, line in enumerate(lines):
+        match = SECTION_RE.match(line)
+        if match is not None:
+            section = match.group(1).strip()
+            continue
+        if section == 'buildout':
+            continue
+        match = PIN_LINE_RE.match(line)
+        if match is not None:
+            index.setdefault(_pin_key(match.group(2)), []).append(number)
+    return index
+
+
+def _read_versions(path):
+    """Read a versions file into its lines and the index of its pins
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    return lines, _index_pins(lines)
+
+
+def _update_pins(lines, index, pins):
+    """Set the versions of the (name, version) pairs in pins, changing the
+    lines in place. Packages without a pin are added after the last pin.
+    Returns the names that had more than one pin and the names that were
+    added.
+    """
+    multiple = []
+    added = []
+    for name, version in pins:
+        numbers = index.get(_pin_key(name))
+        if not numbers:
+            added.append((name, version))
+            continue
+        if len(numbers) > 1:
+            multiple.append(name)
+        for number in numbers:
+            match = PIN_LINE_RE.match(lines[number])
+            lines[number] = '%s%s%s%s' % (match.group(1), version,
+                                          match.group(4) or '',
+                                          match.group(5) or '\n')
+    if added:
+        position = len(lines)
+        if index:
+            position = max([max(numbers) for numbers in index.values()]) + 1
+        if position and not lines[position - 1].endswith('\n'):
+            lines[position - 1] += '\n'
+        lines[position:position] = ['%s = %s\n' % pin for pin in added]
+        for offset, (name, version) in enumerate(added):
+            index[_pin_key(name)] = [position + offset]
+    return multiple, [name for name, version in added]
+
+
+def _get_pins(lines, index, names):
+    """The pinned version of each of the names, None for those that aren't
+    pinned
+    """
+    pins = {}
+    for name in names:
+        numbers = index.get(_pin_key(name))
+        pins[name] = None
+        if numbers:
+            pins[name] = PIN_LINE_RE.match(lines[numbers[0]]).group(3)
+    return pins
+
+
+def _remove_pins(lines, index, names):
+    """Remove the pins of the names, changing the lines in place. The index
+    is rebuilt since the line numbers move.
+    """
+    remove = set()
+    for name in names:
+        remove.update(index.pop(_pin_key(name), []))
+    lines[:] = [line for number, line in enumerate(lines)
+                if number not in remove]
+    index.clear()
+    index.update(_index_pins(lines))
+
+
+def _write_versions(path, lines):
+    """Replace the versions file in one go, so it is never left half
+    written
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
@@ -0,0 +1,72 @@
+"""Wait for the Zope instances of a host to come up after a restart and
+warm them up before the release goes on.
+
+Each instance is first polled on its health path until it answers, then
+all the warm-up paths are requested at the same time, again and again,
+until every one of them answers within the latency threshold. The
+instances of a host are handled at the same time, on the host itself, in
+one round-trip.
+"""
+from fabric import api
+from fabric import colors
+
+WARMUP_SCRIPT = """\
+start=$(date +%%s); deadline=$((start + %(timeout)s)); \
+for u in %(urls)s; do ( \
+until [ "$(curl -s -o /dev/null -m %(timeout)s -w "%%{http_code}" \
+"$u%(health_path)s")" = 200 ]; do \
+if [ $(date +%%s) -ge $deadline ]; then echo "$u timeout health"; exit; fi; \
+sleep 2; done; \
+while :; do \
+if (for p in %(paths)s; do \
+curl -s -o /dev/null -m %(timeout)s -w "%%{http_code} %%{time_total}\\n" \
+"$u$p" & done; wait) | \
+awk '$1 < 200 || $1 >= 400 || $2 >= %(max_latency)s {slow = 1} \
+END {exit slow}'; then \
+echo "$u warm $(($(date +%%s) - start))"; exit; fi; \
+if [ $(date +%%s) -ge $deadline ]; then echo "$u timeout warmup"; exit; fi; \
+sleep 1; done \
+) & done; wait\
+"""
+
+
+def _get_instance_urls():
+    return api.env.get("%s_instance_urls" % api.env.deploy_env, [])
+
+
+def _warm_up():
+    """Wait until the instances on the current host are up and warm.
+    Returns the (url, seconds) each instance took, aborts when one of them
+    doesn't make it in time.
+    """
+    instance_urls = _get_instance_urls()
+    if not instance_urls:
+        return []
+    urls = " ".join(['"%s"' % url.rstrip('/') for url in instance_urls])
+    paths = " ".join(['"%s"' % path for path in api.env.warmup_paths])
+    health_path = api.env.health_path
+    max_latency = float(api.env.warmup_max_latency)
+    timeout = int(api.env.warmup_timeout)
+    print colors.blue("Warming up %s" % ", ".join(instance_urls))
+    with api.settings(api.hide('running', 'stdout'), warn_only=True):
+        result = api.run(WARMUP_SCRIPT % locals())
+    warm = []
+    failed = []
+    for line in result.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        url, status, detail = parts
+        if status == 'warm':
+            warm.append((url, int(detail)))
+        else:
+            failed.append("%s (%s)" % (url, detail))
+    missing = set([url.rstrip('/') for url in instance_urls]) - set(
+        [url for url, seconds in warm])
+    if failed or missing:
+        api.abort("Instances on %s aren't ready: %s" % (
+            api.env.host_string,
+            ", ".join(failed or sorted(missing))))
+    for url, seconds in warm:
+        print "    %s warm after %ss" % (url, seconds)
+    return warm